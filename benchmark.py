@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import resource
+import datetime
+import tempfile
+import statistics
+import subprocess
+
+import httpx
+
+from jobs import media_executor
+from media import concat_audios, append_audios, render_still_video
+
+# The video command used before the still-image preset, kept for comparison
+def build_legacy_video_command(image_path, audio_path, output_path, duration):
+    return [
+        'ffmpeg', '-loop', '1', '-i', image_path,
+        '-i', audio_path,
+        '-c:v', 'libx264', '-tune', 'stillimage',
+        '-c:a', 'aac', '-b:a', '192k',
+        '-pix_fmt', 'yuv420p',
+        '-shortest', '-t', str(duration),
+        '-y', output_path
+    ]
+
+# Generate a sine tone MP3 and a large test image
+async def make_video_inputs(work_dir, duration):
+    audio_path = os.path.join(work_dir, 'tone.mp3')
+    image_path = os.path.join(work_dir, 'image.jpg')
+    await media_executor.run_process([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi',
+        '-i', f'sine=frequency=440:sample_rate=44100:duration={duration}',
+        '-ac', '2', '-c:a', 'libmp3lame', '-b:a', '128k', '-y', audio_path
+    ])
+    await media_executor.run_process([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi',
+        '-i', 'testsrc2=size=3840x2160', '-frames:v', '1', '-y', image_path
+    ])
+    return image_path, audio_path
+
+async def timed(coro):
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+async def bench_video(duration):
+    with tempfile.TemporaryDirectory() as work_dir:
+        image_path, audio_path = await make_video_inputs(work_dir, duration)
+        legacy_path = os.path.join(work_dir, 'legacy.mp4')
+        still_path = os.path.join(work_dir, 'still.mp4')
+
+        legacy = await timed(media_executor.run_process(
+            build_legacy_video_command(image_path, audio_path, legacy_path, duration)
+        ))
+        still = await timed(render_still_video(image_path, audio_path, still_path))
+
+        print(f"audio duration: {duration}s")
+        for name, elapsed, path in (('legacy', legacy, legacy_path), ('still', still, still_path)):
+            size = os.path.getsize(path) / 1024 / 1024
+            print(f"{name:>8}: {elapsed:8.2f}s  {duration / elapsed:8.1f}x realtime  {size:8.2f} MB")
+        print(f" speedup: {legacy / still:.1f}x")
+
+# lavfi sources for the synthetic inputs
+AUDIO_SOURCES = {
+    'tone': lambda duration, rate: f'sine=frequency=440:sample_rate={rate}:duration={duration}',
+    'silence': lambda duration, rate: f'anullsrc=r={rate}:cl=stereo:d={duration}',
+    'noise': lambda duration, rate: f'anoisesrc=d={duration}:c=pink:r={rate}:a=0.2'
+}
+
+# Encoder settings per container, close to what Telegram clients send
+AUDIO_FORMATS = {
+    'mp3': ['-c:a', 'libmp3lame', '-b:a', '128k'],
+    'ogg': ['-c:a', 'libopus', '-b:a', '64k'],
+    'm4a': ['-c:a', 'aac', '-b:a', '128k'],
+    'wav': ['-c:a', 'pcm_s16le']
+}
+
+SCENARIOS = ('merge_copy', 'merge_mixed', 'add_more', 'video')
+
+# Metrics compared between runs; lower is better for all of them.
+# temp_disk_bytes is the peak growth of the job's scratch directory
+# (intermediates and the output), output_bytes what the job added to it.
+RESULT_KEYS = ('wall_s', 'cpu_s', 'peak_rss_mb', 'temp_disk_bytes', 'output_bytes')
+
+async def make_audio(work_dir, name, source, fmt, duration, rate=44100):
+    path = os.path.join(work_dir, f'{name}.{fmt}')
+    await media_executor.run_process([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', AUDIO_SOURCES[source](duration, rate), '-ac', '2'
+    ] + AUDIO_FORMATS[fmt] + ['-y', path])
+    return path
+
+async def make_image(work_dir, size='3840x2160'):
+    path = os.path.join(work_dir, 'image.jpg')
+    await media_executor.run_process([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'testsrc2=size={size}', '-frames:v', '1', '-y', path
+    ])
+    return path
+
+def dir_size(path):
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+# Generate the inputs of a scenario (not measured); returns the spec the
+# measuring process runs
+async def prepare_scenario(scenario, work_dir, files, duration):
+    inputs_dir = os.path.join(work_dir, 'inputs')
+    out_dir = os.path.join(work_dir, 'out')
+    os.makedirs(inputs_dir)
+    os.makedirs(out_dir)
+    spec = {'scenario': scenario, 'output': os.path.join(out_dir, 'result')}
+
+    # Same-format MP3s: the stream-copy path
+    async def copyable(count, prefix):
+        return await asyncio.gather(*(
+            make_audio(inputs_dir, f'{prefix}{index}', 'tone', 'mp3', duration) for index in range(count)
+        ))
+
+    # Every source and container mixed: the streaming re-encode path
+    async def mixed(count, prefix):
+        sources = list(AUDIO_SOURCES)
+        formats = list(AUDIO_FORMATS)
+        return await asyncio.gather(*(
+            make_audio(inputs_dir, f'{prefix}{index}', sources[index % len(sources)], formats[index % len(formats)], duration)
+            for index in range(count)
+        ))
+
+    if scenario == 'merge_copy':
+        spec['inputs'] = await copyable(files, 'copy')
+        spec['output'] += '.mp3'
+    elif scenario == 'merge_mixed':
+        spec['inputs'] = await mixed(files, 'mixed')
+        spec['output'] += '.mp3'
+    elif scenario == 'add_more':
+        # A previous merge result, then a mixed round of new files
+        spec['base'] = os.path.join(inputs_dir, 'base.mp3')
+        await concat_audios(await copyable(files, 'base'), spec['base'])
+        spec['inputs'] = await mixed(max(2, files // 2), 'new')
+        spec['output'] += '.mp3'
+    elif scenario == 'video':
+        spec['inputs'] = [await make_audio(inputs_dir, 'audio', 'tone', 'mp3', duration * files)]
+        spec['image'] = await make_image(inputs_dir)
+        spec['output'] += '.mp4'
+    return spec
+
+def _cpu(usage):
+    return usage.ru_utime + usage.ru_stime
+
+# Run one prepared scenario and print its measurements as JSON. Runs in a
+# fresh process so peak RSS and CPU time cover only this scenario's work.
+async def measure_scenario(spec):
+    scenario = spec['scenario']
+    out_dir = os.path.dirname(spec['output'])
+    if 'base' in spec:
+        shutil.copyfile(spec['base'], spec['output'])
+    elif os.path.exists(spec['output']):
+        os.remove(spec['output'])
+
+    start_bytes = dir_size(out_dir)
+    peak_bytes = start_bytes
+
+    async def sample_disk():
+        nonlocal peak_bytes
+        while True:
+            peak_bytes = max(peak_bytes, dir_size(out_dir))
+            await asyncio.sleep(0.02)
+
+    sampler = asyncio.create_task(sample_disk())
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    try:
+        if scenario in ('merge_copy', 'merge_mixed'):
+            await concat_audios(spec['inputs'], spec['output'])
+        elif scenario == 'add_more':
+            await append_audios(spec['output'], spec['inputs'])
+        elif scenario == 'video':
+            await render_still_video(spec['image'], spec['inputs'][0], spec['output'])
+        wall = time.perf_counter() - start
+    finally:
+        sampler.cancel()
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak_bytes = max(peak_bytes, dir_size(out_dir))
+
+    return {
+        'wall_s': wall,
+        'cpu_s': _cpu(self_after) - _cpu(self_before) + _cpu(children_after) - _cpu(children_before),
+        # ru_maxrss is in KiB on Linux; the largest of the bot and any ffmpeg child
+        'peak_rss_mb': max(self_after.ru_maxrss, children_after.ru_maxrss) / 1024,
+        'temp_disk_bytes': peak_bytes - start_bytes,
+        'output_bytes': os.path.getsize(spec['output']) - (os.path.getsize(spec['base']) if 'base' in spec else 0)
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Run every scenario `repeat` times (each run in its own process) and keep
+# the median of each measurement
+async def run_suite(scenarios, files, duration, repeat):
+    results = {}
+    for scenario in scenarios:
+        runs = []
+        with tempfile.TemporaryDirectory() as work_dir:
+            spec = await prepare_scenario(scenario, work_dir, files, duration)
+            for _ in range(repeat):
+                process = await asyncio.create_subprocess_exec(
+                    sys.executable, os.path.abspath(__file__), 'measure', json.dumps(spec),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                stdout, stderr = await process.communicate()
+                if process.returncode != 0:
+                    raise RuntimeError(f"{scenario} failed: {stderr.decode().strip()}")
+                runs.append(json.loads(stdout.decode().strip().splitlines()[-1]))
+        results[scenario] = {key: statistics.median(run[key] for run in runs) for key in RESULT_KEYS}
+        print_result(scenario, results[scenario])
+    return results
+
+def print_result(scenario, result):
+    print(
+        f"{scenario:>12}: {result['wall_s']:8.2f}s wall  {result['cpu_s']:8.2f}s cpu  "
+        f"{result['peak_rss_mb']:7.1f} MB rss  {result['temp_disk_bytes'] / 1024 / 1024:8.2f} MB temp  "
+        f"{result['output_bytes'] / 1024 / 1024:8.2f} MB out"
+    )
+
+# Print the change of every measurement against an earlier results file
+def compare_results(baseline, results):
+    print(f"\ncompared with {baseline.get('commit') or 'baseline'} ({baseline.get('created')}):")
+    for scenario, result in results.items():
+        old = baseline['results'].get(scenario)
+        if old is None:
+            continue
+        changes = []
+        for key in RESULT_KEYS:
+            if old[key]:
+                changes.append(f"{key} {(result[key] - old[key]) / old[key] * 100:+.1f}%")
+        print(f"{scenario:>12}: " + '  '.join(changes))
+
+# A /start message update from user `index`, used when no recording is given
+def make_start_update(index):
+    user = {'id': 100000 + index, 'is_bot': False, 'first_name': f'user{index}'}
+    return {
+        'update_id': index,
+        'message': {
+            'message_id': index,
+            'date': int(time.time()),
+            'chat': {'id': user['id'], 'type': 'private'},
+            'from': user,
+            'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+        }
+    }
+
+# Replay updates (one JSON object per line in `updates_path`) against a
+# running webhook server and report throughput and acknowledgement latency
+async def bench_webhook(url, updates_path, count, concurrency, secret):
+    if updates_path:
+        with open(updates_path) as f:
+            recorded = [json.loads(line) for line in f if line.strip()]
+    else:
+        recorded = [make_start_update(index) for index in range(count)]
+    updates = [recorded[index % len(recorded)] for index in range(count)]
+
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    async def worker(client):
+        nonlocal errors
+        while not queue.empty():
+            update = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, json=update, headers=headers)
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    print(f"updates: {count}  concurrency: {concurrency}  errors: {errors}")
+    print(f"throughput: {count / elapsed:.0f} updates/s")
+    print(f"latency: p50 {percentile(0.5):.1f} ms  p95 {percentile(0.95):.1f} ms  p99 {percentile(0.99):.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark media pipelines and the webhook server")
+    parser.add_argument('scenario', nargs='?', default='suite', choices=['suite', 'video', 'webhook', 'measure'])
+    parser.add_argument('spec', nargs='?', help=argparse.SUPPRESS)
+    parser.add_argument('--duration', type=int, default=None, help="audio length in seconds (per input for the suite)")
+    parser.add_argument('--files', type=int, default=6, help="inputs per merge scenario")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario (the median is kept)")
+    parser.add_argument('--only', action='append', choices=SCENARIOS, help="run only these suite scenarios")
+    parser.add_argument('--output', help="write suite results to this JSON file")
+    parser.add_argument('--compare', help="suite results JSON of an earlier run to compare with")
+    parser.add_argument('--url', default='http://127.0.0.1:10000/webhook', help="webhook URL to replay updates against")
+    parser.add_argument('--updates', help="recorded updates, one JSON object per line (default: synthetic /start messages)")
+    parser.add_argument('--count', type=int, default=1000, help="number of updates to send")
+    parser.add_argument('--concurrency', type=int, default=20, help="parallel connections")
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET'), help="webhook secret token")
+    args = parser.parse_args()
+
+    if args.scenario == 'measure':
+        print(json.dumps(asyncio.run(measure_scenario(json.loads(args.spec)))))
+    elif args.scenario == 'webhook':
+        asyncio.run(bench_webhook(args.url, args.updates, args.count, args.concurrency, args.secret))
+    elif args.scenario == 'video':
+        asyncio.run(bench_video(args.duration or 600))
+    else:
+        duration = args.duration or 60
+        results = asyncio.run(run_suite(args.only or SCENARIOS, args.files, duration, args.repeat))
+        report = {
+            'commit': git_commit(),
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'params': {'files': args.files, 'duration': duration, 'repeat': args.repeat},
+            'results': results
+        }
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                compare_results(json.load(f), results)
+
+if __name__ == '__main__':
+    sys.exit(main())
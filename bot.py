@@ -1,9 +1,27 @@
 import os
+import time
+import asyncio
 import logging
+import contextlib
+from pathlib import Path
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from pydub import AudioSegment
-import subprocess
+from jobs import job_scheduler, QueueFullError, UserBusyError
+from media import concat_audios, append_audios, merged_duration, probe_audio, render_still_video, MP3_ENCODE_ARGS, MERGE_FADE_MS, MERGE_GAP_MS, NORMALIZE_INPUTS, VIDEO_FPS, VIDEO_GOP, VIDEO_MAX_SIZE, VIDEO_PRESET
+from cache import result_cache, job_key, RESULT_REUSE_MAX_BYTES
+from progress import ProgressReporter
+from downloads import downloads, fetch_file
+from botapi import configure as configure_bot_api, BOT_API_LOCAL, DOWNLOAD_LIMIT, UPLOAD_LIMIT
+from workspace import workspaces, QuotaExceededError
+from sessions import SessionStore, create_backend
+from cleanup import message_cleaner
+import delivery
+from worker import render, render_queue
+from metrics import JOB_SECONDS, current_job, stage_timer
+from updates import ChatOrderedUpdateProcessor
+
+# Settings that change a merged result, part of its result cache key
+MERGE_SETTINGS = (' '.join(MP3_ENCODE_ARGS), MERGE_FADE_MS, MERGE_GAP_MS, NORMALIZE_INPUTS)
 
 # Logging setup
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -12,8 +30,28 @@ logger = logging.getLogger(__name__)
 # Bot token from environment variable
 TOKEN = os.getenv('BOT_TOKEN')
 
-# User data storage
-user_data = {}
+# How often idle sessions are expired (seconds)
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', 60))
+
+# How often changed sessions are written to the session backend (seconds)
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', 5))
+
+# Seconds to wait for more files of the same album before the file list
+# is updated once for all of them
+MEDIA_GROUP_WINDOW = float(os.getenv('MEDIA_GROUP_WINDOW', 1.5))
+
+# user_id -> task that updates the file list once an album is complete
+pending_list_edits = {}
+
+# Free what an evicted session still holds: scratch files and chat messages
+def evict_session(user_id, session):
+    if session.get('workspace'):
+        workspaces.remove(session['workspace'])
+    if session.get('user_messages'):
+        message_cleaner.schedule(user_id, session['user_messages'])
+
+# User data storage (idle sessions expire, users with a running job are kept)
+user_data = SessionStore(on_evict=evict_session, is_pinned=job_scheduler.is_busy, backend=create_backend())
 
 # Main menu keyboard
 def get_main_menu():
@@ -46,12 +84,163 @@ def get_after_merge_options():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+# Get (or create) the scratch workspace of the user's current session
+def get_workspace(user_id):
+    if user_data[user_id].get('workspace'):
+        return workspaces.open(user_data[user_id]['workspace'])
+    workspace = workspaces.create(user_id)
+    user_data[user_id]['workspace'] = workspace.directory
+    return workspace
+
+# Delete the scratch workspace of the user's current session
+def release_workspace(user_id):
+    downloads.cancel_user(user_id)
+    if user_id in user_data and user_data[user_id].get('workspace'):
+        workspaces.remove(user_data[user_id]['workspace'])
+        user_data[user_id]['workspace'] = None
+
+# Session files: lists of files with parallel lists of names and unique
+# IDs, and single files with their name and unique ID
+SESSION_FILE_LISTS = (('audio_files', 'audio_names', 'audio_ids'), ('new_audio_files', 'new_audio_names', 'new_audio_ids'))
+SESSION_FILES = (('image', 'image_name', 'image_id'), ('audio', 'audio_name', 'audio_id'))
+
+# Paths of every file a session refers to
+def session_files(session):
+    paths = []
+    for keys in SESSION_FILE_LISTS:
+        paths += session.get(keys[0]) or []
+    for keys in SESSION_FILES:
+        if session.get(keys[0]):
+            paths.append(session[keys[0]])
+    return paths
+
+# Remove a file from a session together with its name and ID; returns the
+# file's name, or None when the session does not refer to it
+def drop_session_file(session, path):
+    for keys in SESSION_FILE_LISTS:
+        files = session.get(keys[0]) or []
+        if path in files:
+            index = files.index(path)
+            name = session[keys[1]][index]
+            for key in keys:
+                del session[key][index]
+            return name
+    for keys in SESSION_FILES:
+        if session.get(keys[0]) == path:
+            name = session.get(keys[1])
+            for key in keys:
+                session[key] = None
+            return name
+    return None
+
+# Number for the workspace file name of the next file in a session list;
+# unlike the list length it never repeats once an entry was dropped
+def next_file_number(user_id, key):
+    session = user_data[user_id]
+    number = max(len(session[key]), session.get(f'{key}_next', 0))
+    session[f'{key}_next'] = number + 1
+    return number
+
+# Download an attachment of the user's session in the background. A file
+# whose download fails is dropped from the session and the user is asked to
+# send it again, so a later "done" does not trip over the missing file.
+def start_download(context: ContextTypes.DEFAULT_TYPE, user_id, attachment, path):
+    task = downloads.start(user_id, attachment, path)
+
+    def finished(task):
+        if task.cancelled() or task.exception() is None or user_id not in user_data:
+            return
+        name = drop_session_file(user_data[user_id], path)
+        if name is not None:
+            context.application.create_task(report_failed_download(context, user_id, name))
+
+    task.add_done_callback(finished)
+    return task
+
+async def report_failed_download(context: ContextTypes.DEFAULT_TYPE, user_id, name):
+    try:
+        msg = await context.bot.send_message(
+            chat_id=user_id,
+            text=f"❌ {name} ডাউনলোড করা যায়নি, তাই তালিকা থেকে বাদ দেওয়া হয়েছে।\n\nফাইলটি আবার পাঠান।"
+        )
+    except Exception as e:
+        logger.error(f"Error reporting failed download: {e}")
+        return
+    if user_id in user_data:
+        user_data[user_id].setdefault('user_messages', []).append(msg.message_id)
+
+# Reply to a file message; of an album only the first file gets the reply
+async def reply_once(update: Update, text):
+    user_id = update.effective_user.id
+    album = update.message.media_group_id
+    if album is not None and user_data[user_id].get('replied_album') == album:
+        return
+    user_data[user_id]['replied_album'] = album
+    msg = await update.message.reply_text(text)
+    user_data[user_id]['user_messages'].append(msg.message_id)
+
+# Check the Bot API download limit and the scratch quota before a download;
+# tell the user if the file doesn't fit
+async def reserve_space(update: Update, workspace, nbytes):
+    if nbytes and nbytes > DOWNLOAD_LIMIT:
+        await reply_once(update, f"❌ ফাইলটি অনেক বড়! সর্বোচ্চ {DOWNLOAD_LIMIT // (1024 * 1024)} MB পর্যন্ত ফাইল পাঠান।")
+        return False
+    try:
+        workspace.reserve(nbytes or 0)
+        return True
+    except QuotaExceededError as e:
+        if e.scope == 'user':
+            text = "❌ আপনার ফাইলগুলোর মোট সাইজ সীমা ছাড়িয়ে গেছে। কম ফাইল দিয়ে আবার চেষ্টা করুন।"
+        else:
+            text = "❌ সার্ভারে এখন জায়গা নেই। কিছুক্ষণ পর আবার চেষ্টা করুন।"
+        await reply_once(update, text)
+        return False
+
+# Show the updated file list in the main message. Each file of an album
+# (media group) arrives as its own update; for those the edit waits until
+# no further file of the album came for MEDIA_GROUP_WINDOW seconds, so the
+# whole album costs one edit.
+async def edit_file_list(update: Update, context: ContextTypes.DEFAULT_TYPE, text):
+    user_id = update.effective_user.id
+    cancel_file_list_edit(user_id)
+    message_id = user_data[user_id]['main_message_id']
+    
+    async def edit():
+        await context.bot.edit_message_text(
+            chat_id=user_id,
+            message_id=message_id,
+            text=text,
+            reply_markup=get_done_button(),
+            parse_mode='Markdown'
+        )
+    
+    if update.message.media_group_id is None:
+        await edit()
+        return
+    
+    async def edit_later():
+        await asyncio.sleep(MEDIA_GROUP_WINDOW)
+        pending_list_edits.pop(user_id, None)
+        try:
+            await edit()
+        except Exception as e:
+            logger.error(f"Error updating file list: {e}")
+    
+    pending_list_edits[user_id] = context.application.create_task(edit_later(), update=update)
+
+# Drop a file list edit still waiting for the rest of an album
+def cancel_file_list_edit(user_id):
+    task = pending_list_edits.pop(user_id, None)
+    if task is not None:
+        task.cancel()
+
 # Start command
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Reset user data
     if user_id in user_data:
+        release_workspace(user_id)
         del user_data[user_id]
     
     welcome_text = """
@@ -80,14 +269,33 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='Markdown'
         )
 
+# Why the files collected so far cannot be merged yet, or None
+def merge_not_ready(user_id):
+    session = user_data.get(user_id, {})
+    if session.get('mode') == 'add_more':
+        if not session.get('new_audio_files'):
+            return "❌ কমপক্ষে ১টা নতুন অডিও পাঠান!"
+    elif len(session.get('audio_files', [])) < 2:
+        return "❌ কমপক্ষে ২টা অডিও পাঠান!"
+    return None
+
 # Handle button clicks
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    
     user_id = update.effective_user.id
     action = query.data
     
+    # A "done" press that cannot be merged yet is answered with an alert
+    # here, before it takes a place in the job queue
+    problem = merge_not_ready(user_id) if action == "done" else None
+    if problem:
+        await query.answer(problem, show_alert=True)
+        return
+    await query.answer()
+    
+    # Every button replaces the main message a pending file list edit targets
+    cancel_file_list_edit(user_id)
+    
     # Initialize user data if not exists
     if user_id not in user_data:
         user_data[user_id] = {}
@@ -101,7 +309,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif action == "cancel":
         await cancel_action(update, context)
     elif action == "done":
-        await merge_audios(update, context)
+        # Queue the merge in the background so other updates keep flowing
+        context.application.create_task(run_scheduled_job(update, context, merge_audios), update=update)
     elif action == "add_more":
         await add_more_audio(update, context)
 
@@ -109,10 +318,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_merge(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
+    release_workspace(user_id)
     user_data[user_id] = {
         'mode': 'merge',
         'audio_files': [],
         'audio_names': [],
+        'audio_ids': [],
         'main_message_id': update.callback_query.message.message_id,
         'user_messages': []
     }
@@ -146,6 +357,7 @@ async def add_more_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_data[user_id]['mode'] = 'add_more'
     user_data[user_id]['new_audio_files'] = []
     user_data[user_id]['new_audio_names'] = []
+    user_data[user_id]['new_audio_ids'] = []
     user_data[user_id]['main_message_id'] = update.callback_query.message.message_id
     
     text = """
@@ -170,6 +382,7 @@ async def add_more_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
+    release_workspace(user_id)
     user_data[user_id] = {
         'mode': 'video',
         'image': None,
@@ -228,37 +441,19 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
-# Cancel action
+# Cancel action: stop a waiting or running job first (its ffmpeg processes
+# are killed and its slot freed), then drop the session's files
 async def cancel_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    # Delete user's messages
+    await job_scheduler.cancel(user_id)
+    
+    # Delete user's messages in the background
     if user_id in user_data and 'user_messages' in user_data[user_id]:
-        for msg_id in user_data[user_id]['user_messages']:
-            try:
-                await context.bot.delete_message(chat_id=user_id, message_id=msg_id)
-            except:
-                pass
+        message_cleaner.schedule(user_id, user_data[user_id]['user_messages'])
     
     # Clean up files
-    if user_id in user_data:
-        if 'audio_files' in user_data[user_id]:
-            for file_path in user_data[user_id]['audio_files']:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-        if 'new_audio_files' in user_data[user_id]:
-            for file_path in user_data[user_id]['new_audio_files']:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-        if 'merged_file' in user_data[user_id] and user_data[user_id]['merged_file']:
-            if os.path.exists(user_data[user_id]['merged_file']):
-                os.remove(user_data[user_id]['merged_file'])
-        if 'image' in user_data[user_id] and user_data[user_id]['image']:
-            if os.path.exists(user_data[user_id]['image']):
-                os.remove(user_data[user_id]['image'])
-        if 'audio' in user_data[user_id] and user_data[user_id]['audio']:
-            if os.path.exists(user_data[user_id]['audio']):
-                os.remove(user_data[user_id]['audio'])
+    release_workspace(user_id)
     
     # Return to main menu
     await start(update, context)
@@ -289,14 +484,12 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
                any(mime in mime_type for mime in audio_mimes)
     
     if not is_audio:
-        msg = await update.message.reply_text("❌ শুধুমাত্র অডিও ফাইল পাঠান!")
-        user_data[user_id]['user_messages'].append(msg.message_id)
+        await reply_once(update, "❌ শুধুমাত্র অডিও ফাইল পাঠান!")
         return
     
     # Check mode
     if user_id not in user_data or 'mode' not in user_data[user_id]:
-        msg = await update.message.reply_text("প্রথমে মূল মেনু থেকে একটা অপশন বেছে নিন। /start চাপুন।")
-        user_data[user_id]['user_messages'].append(msg.message_id)
+        await reply_once(update, "প্রথমে মূল মেনু থেকে একটা অপশন বেছে নিন। /start চাপুন।")
         return
     
     mode = user_data[user_id]['mode']
@@ -323,8 +516,7 @@ async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Check mode
     if user_id not in user_data or 'mode' not in user_data[user_id]:
-        msg = await update.message.reply_text("প্রথমে মূল মেনু থেকে একটা অপশন বেছে নিন। /start চাপুন।")
-        user_data[user_id]['user_messages'].append(msg.message_id)
+        await reply_once(update, "প্রথমে মূল মেনু থেকে একটা অপশন বেছে নিন। /start চাপুন।")
         return
     
     mode = user_data[user_id]['mode']
@@ -351,8 +543,7 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Check mode
     if user_id not in user_data or 'mode' not in user_data[user_id]:
-        msg = await update.message.reply_text("প্রথমে মূল মেনু থেকে একটা অপশন বেছে নিন। /start চাপুন।")
-        user_data[user_id]['user_messages'].append(msg.message_id)
+        await reply_once(update, "প্রথমে মূল মেনু থেকে একটা অপশন বেছে নিন। /start চাপুন।")
         return
     
     mode = user_data[user_id]['mode']
@@ -384,12 +575,15 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        # Download photo
-        photo_file = await update.message.photo[-1].get_file()
-        photo_path = f"image_{user_id}.jpg"
-        await photo_file.download_to_drive(photo_path)
+        # Download photo in the background
+        workspace = get_workspace(user_id)
+        if not await reserve_space(update, workspace, update.message.photo[-1].file_size):
+            return
+        photo_path = workspace.path("image.jpg")
+        start_download(context, user_id, update.message.photo[-1], photo_path)
         
         user_data[user_id]['image'] = photo_path
+        user_data[user_id]['image_id'] = update.message.photo[-1].file_unique_id
         user_data[user_id]['image_name'] = "ছবি.jpg"
         
         # Update main message
@@ -418,16 +612,19 @@ async def handle_merge_audio(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     
     try:
-        # Download audio
-        audio_file = await update.message.audio.get_file()
-        audio_path = f"audio_{user_id}_{len(user_data[user_id]['audio_files'])}.mp3"
-        await audio_file.download_to_drive(audio_path)
+        # Download audio in the background
+        workspace = get_workspace(user_id)
+        if not await reserve_space(update, workspace, update.message.audio.file_size):
+            return
+        audio_path = workspace.path(f"audio_{next_file_number(user_id, 'audio_files')}.mp3")
+        start_download(context, user_id, update.message.audio, audio_path)
         
         # Get audio name
         audio_name = update.message.audio.file_name or f"অডিও_{len(user_data[user_id]['audio_files']) + 1}.mp3"
         
         user_data[user_id]['audio_files'].append(audio_path)
         user_data[user_id]['audio_names'].append(audio_name)
+        user_data[user_id]['audio_ids'].append(update.message.audio.file_unique_id)
         
         # Update main message
         audio_list = "\n".join([f"  {i+1}. {name}" for i, name in enumerate(user_data[user_id]['audio_names'])])
@@ -443,13 +640,7 @@ async def handle_merge_audio(update: Update, context: ContextTypes.DEFAULT_TYPE)
 আরো অডিও পাঠান অথবা "✅ মার্জ সম্পন্ন করুন" বাটন ক্লিক করুন
 """
         
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=user_data[user_id]['main_message_id'],
-            text=text,
-            reply_markup=get_done_button(),
-            parse_mode='Markdown'
-        )
+        await edit_file_list(update, context, text)
         
     except Exception as e:
         logger.error(f"Error handling audio: {e}")
@@ -459,14 +650,17 @@ async def handle_merge_document(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = update.effective_user.id
     
     try:
-        # Download document
-        doc_file = await update.message.document.get_file()
+        # Download document in the background
+        workspace = get_workspace(user_id)
+        if not await reserve_space(update, workspace, update.message.document.file_size):
+            return
         file_name = update.message.document.file_name or f"audio_{len(user_data[user_id]['audio_files'])}.mp3"
-        audio_path = f"doc_{user_id}_{len(user_data[user_id]['audio_files'])}_{file_name}"
-        await doc_file.download_to_drive(audio_path)
+        audio_path = workspace.path(f"doc_{next_file_number(user_id, 'audio_files')}_{os.path.basename(file_name)}")
+        start_download(context, user_id, update.message.document, audio_path)
         
         user_data[user_id]['audio_files'].append(audio_path)
         user_data[user_id]['audio_names'].append(file_name)
+        user_data[user_id]['audio_ids'].append(update.message.document.file_unique_id)
         
         # Update main message
         audio_list = "\n".join([f"  {i+1}. {name}" for i, name in enumerate(user_data[user_id]['audio_names'])])
@@ -482,13 +676,7 @@ async def handle_merge_document(update: Update, context: ContextTypes.DEFAULT_TY
 আরো অডিও পাঠান অথবা "✅ মার্জ সম্পন্ন করুন" বাটন ক্লিক করুন
 """
         
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=user_data[user_id]['main_message_id'],
-            text=text,
-            reply_markup=get_done_button(),
-            parse_mode='Markdown'
-        )
+        await edit_file_list(update, context, text)
         
     except Exception as e:
         logger.error(f"Error handling document: {e}")
@@ -498,15 +686,18 @@ async def handle_merge_voice(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     
     try:
-        # Download voice
-        voice_file = await update.message.voice.get_file()
-        voice_path = f"voice_{user_id}_{len(user_data[user_id]['audio_files'])}.ogg"
-        await voice_file.download_to_drive(voice_path)
+        # Download voice in the background
+        workspace = get_workspace(user_id)
+        if not await reserve_space(update, workspace, update.message.voice.file_size):
+            return
+        voice_path = workspace.path(f"voice_{next_file_number(user_id, 'audio_files')}.ogg")
+        start_download(context, user_id, update.message.voice, voice_path)
         
         voice_name = f"ভয়েস_{len(user_data[user_id]['audio_files']) + 1}.ogg"
         
         user_data[user_id]['audio_files'].append(voice_path)
         user_data[user_id]['audio_names'].append(voice_name)
+        user_data[user_id]['audio_ids'].append(update.message.voice.file_unique_id)
         
         # Update main message
         audio_list = "\n".join([f"  {i+1}. {name}" for i, name in enumerate(user_data[user_id]['audio_names'])])
@@ -522,13 +713,7 @@ async def handle_merge_voice(update: Update, context: ContextTypes.DEFAULT_TYPE)
 আরো অডিও/ভয়েস পাঠান অথবা "✅ মার্জ সম্পন্ন করুন" বাটন ক্লিক করুন
 """
         
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=user_data[user_id]['main_message_id'],
-            text=text,
-            reply_markup=get_done_button(),
-            parse_mode='Markdown'
-        )
+        await edit_file_list(update, context, text)
         
     except Exception as e:
         logger.error(f"Error handling voice: {e}")
@@ -538,15 +723,18 @@ async def handle_add_more_audio(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = update.effective_user.id
     
     try:
-        # Download audio
-        audio_file = await update.message.audio.get_file()
-        audio_path = f"add_audio_{user_id}_{len(user_data[user_id]['new_audio_files'])}.mp3"
-        await audio_file.download_to_drive(audio_path)
+        # Download audio in the background
+        workspace = get_workspace(user_id)
+        if not await reserve_space(update, workspace, update.message.audio.file_size):
+            return
+        audio_path = workspace.path(f"add_audio_{next_file_number(user_id, 'new_audio_files')}.mp3")
+        start_download(context, user_id, update.message.audio, audio_path)
         
         audio_name = update.message.audio.file_name or f"অডিও_{len(user_data[user_id]['new_audio_files']) + 1}.mp3"
         
         user_data[user_id]['new_audio_files'].append(audio_path)
         user_data[user_id]['new_audio_names'].append(audio_name)
+        user_data[user_id]['new_audio_ids'].append(update.message.audio.file_unique_id)
         
         # Update main message
         audio_list = "\n".join([f"  {i+1}. {name}" for i, name in enumerate(user_data[user_id]['new_audio_names'])])
@@ -562,13 +750,7 @@ async def handle_add_more_audio(update: Update, context: ContextTypes.DEFAULT_TY
 আরো পাঠান অথবা "✅ মার্জ সম্পন্ন করুন" বাটন ক্লিক করুন
 """
         
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=user_data[user_id]['main_message_id'],
-            text=text,
-            reply_markup=get_done_button(),
-            parse_mode='Markdown'
-        )
+        await edit_file_list(update, context, text)
         
     except Exception as e:
         logger.error(f"Error handling add more audio: {e}")
@@ -578,14 +760,17 @@ async def handle_add_more_document(update: Update, context: ContextTypes.DEFAULT
     user_id = update.effective_user.id
     
     try:
-        # Download document
-        doc_file = await update.message.document.get_file()
+        # Download document in the background
+        workspace = get_workspace(user_id)
+        if not await reserve_space(update, workspace, update.message.document.file_size):
+            return
         file_name = update.message.document.file_name or f"audio_{len(user_data[user_id]['new_audio_files'])}.mp3"
-        audio_path = f"add_doc_{user_id}_{len(user_data[user_id]['new_audio_files'])}_{file_name}"
-        await doc_file.download_to_drive(audio_path)
+        audio_path = workspace.path(f"add_doc_{next_file_number(user_id, 'new_audio_files')}_{os.path.basename(file_name)}")
+        start_download(context, user_id, update.message.document, audio_path)
         
         user_data[user_id]['new_audio_files'].append(audio_path)
         user_data[user_id]['new_audio_names'].append(file_name)
+        user_data[user_id]['new_audio_ids'].append(update.message.document.file_unique_id)
         
         # Update main message
         audio_list = "\n".join([f"  {i+1}. {name}" for i, name in enumerate(user_data[user_id]['new_audio_names'])])
@@ -601,13 +786,7 @@ async def handle_add_more_document(update: Update, context: ContextTypes.DEFAULT
 আরো পাঠান অথবা "✅ মার্জ সম্পন্ন করুন" বাটন ক্লিক করুন
 """
         
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=user_data[user_id]['main_message_id'],
-            text=text,
-            reply_markup=get_done_button(),
-            parse_mode='Markdown'
-        )
+        await edit_file_list(update, context, text)
         
     except Exception as e:
         logger.error(f"Error handling add more document: {e}")
@@ -617,15 +796,18 @@ async def handle_add_more_voice(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = update.effective_user.id
     
     try:
-        # Download voice
-        voice_file = await update.message.voice.get_file()
-        voice_path = f"add_voice_{user_id}_{len(user_data[user_id]['new_audio_files'])}.ogg"
-        await voice_file.download_to_drive(voice_path)
+        # Download voice in the background
+        workspace = get_workspace(user_id)
+        if not await reserve_space(update, workspace, update.message.voice.file_size):
+            return
+        voice_path = workspace.path(f"add_voice_{next_file_number(user_id, 'new_audio_files')}.ogg")
+        start_download(context, user_id, update.message.voice, voice_path)
         
         voice_name = f"ভয়েস_{len(user_data[user_id]['new_audio_files']) + 1}.ogg"
         
         user_data[user_id]['new_audio_files'].append(voice_path)
         user_data[user_id]['new_audio_names'].append(voice_name)
+        user_data[user_id]['new_audio_ids'].append(update.message.voice.file_unique_id)
         
         # Update main message
         audio_list = "\n".join([f"  {i+1}. {name}" for i, name in enumerate(user_data[user_id]['new_audio_names'])])
@@ -641,13 +823,7 @@ async def handle_add_more_voice(update: Update, context: ContextTypes.DEFAULT_TY
 আরো পাঠান অথবা "✅ মার্জ সম্পন্ন করুন" বাটন ক্লিক করুন
 """
         
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=user_data[user_id]['main_message_id'],
-            text=text,
-            reply_markup=get_done_button(),
-            parse_mode='Markdown'
-        )
+        await edit_file_list(update, context, text)
         
     except Exception as e:
         logger.error(f"Error handling add more voice: {e}")
@@ -660,18 +836,21 @@ async def handle_video_audio(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     try:
-        # Download audio
-        audio_file = await update.message.audio.get_file()
-        audio_path = f"video_audio_{user_id}.mp3"
-        await audio_file.download_to_drive(audio_path)
+        # Download audio in the background
+        workspace = get_workspace(user_id)
+        if not await reserve_space(update, workspace, update.message.audio.file_size):
+            return
+        audio_path = workspace.path("video_audio.mp3")
+        start_download(context, user_id, update.message.audio, audio_path)
         
         audio_name = update.message.audio.file_name or "অডিও.mp3"
         
         user_data[user_id]['audio'] = audio_path
+        user_data[user_id]['audio_id'] = update.message.audio.file_unique_id
         user_data[user_id]['audio_name'] = audio_name
         
-        # Create video
-        await create_video(update, context)
+        # Queue video creation in the background
+        context.application.create_task(run_scheduled_job(update, context, create_video), update=update)
         
     except Exception as e:
         logger.error(f"Error handling video audio: {e}")
@@ -684,17 +863,20 @@ async def handle_video_document(update: Update, context: ContextTypes.DEFAULT_TY
         return
     
     try:
-        # Download document
-        doc_file = await update.message.document.get_file()
+        # Download document in the background
+        workspace = get_workspace(user_id)
+        if not await reserve_space(update, workspace, update.message.document.file_size):
+            return
         file_name = update.message.document.file_name or "audio.mp3"
-        audio_path = f"video_doc_{user_id}_{file_name}"
-        await doc_file.download_to_drive(audio_path)
+        audio_path = workspace.path(f"video_doc_{os.path.basename(file_name)}")
+        start_download(context, user_id, update.message.document, audio_path)
         
         user_data[user_id]['audio'] = audio_path
+        user_data[user_id]['audio_id'] = update.message.document.file_unique_id
         user_data[user_id]['audio_name'] = file_name
         
-        # Create video
-        await create_video(update, context)
+        # Queue video creation in the background
+        context.application.create_task(run_scheduled_job(update, context, create_video), update=update)
         
     except Exception as e:
         logger.error(f"Error handling video document: {e}")
@@ -707,16 +889,19 @@ async def handle_video_voice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     try:
-        # Download voice
-        voice_file = await update.message.voice.get_file()
-        voice_path = f"video_voice_{user_id}.ogg"
-        await voice_file.download_to_drive(voice_path)
+        # Download voice in the background
+        workspace = get_workspace(user_id)
+        if not await reserve_space(update, workspace, update.message.voice.file_size):
+            return
+        voice_path = workspace.path("video_voice.ogg")
+        start_download(context, user_id, update.message.voice, voice_path)
         
         user_data[user_id]['audio'] = voice_path
+        user_data[user_id]['audio_id'] = update.message.voice.file_unique_id
         user_data[user_id]['audio_name'] = "ভয়েস.ogg"
         
-        # Create video
-        await create_video(update, context)
+        # Queue video creation in the background
+        context.application.create_task(run_scheduled_job(update, context, create_video), update=update)
         
     except Exception as e:
         logger.error(f"Error handling video voice: {e}")
@@ -727,97 +912,192 @@ def get_progress_bar(percentage):
     empty = 10 - filled
     return "▓" * filled + "░" * empty
 
+# Callback showing a render worker's progress (0 to 1) as the 40-90%
+# stretch of a job's status message
+def show_render_progress(progress, title, detail):
+    def show(share):
+        percent = 40 + int(share * 50)
+        progress.update(
+            f"⏳ *{title}*\n\n{get_progress_bar(percent)} {percent}%\n\n{detail}",
+            reply_markup=get_cancel_button(),
+            parse_mode='Markdown'
+        )
+    return show
+
+# Run a merge/video job through the scheduler, showing the queue position
+async def run_scheduled_job(update: Update, context: ContextTypes.DEFAULT_TYPE, job):
+    user_id = update.effective_user.id
+    progress = ProgressReporter(context.bot, user_id, user_data[user_id]['main_message_id'])
+    
+    # Label for the timings recorded while this job runs (own task context)
+    if job is create_video:
+        job_type = 'video'
+    elif user_data[user_id].get('mode') == 'add_more':
+        job_type = 'add_more'
+    else:
+        job_type = 'merge'
+    current_job.set(job_type)
+    
+    async def show_position(position):
+        progress.update(
+            f"⏳ *লাইনে অপেক্ষা করছেন...*\n\n📋 আপনার সিরিয়াল: {position}\n\nআপনার পালা এলে কাজ শুরু হবে",
+            reply_markup=get_cancel_button(),
+            parse_mode='Markdown'
+        )
+    
+    async def start_job():
+        # The job reports its own progress from here on
+        await progress.close()
+        return await job(update, context)
+    
+    try:
+        started = time.perf_counter()
+        await job_scheduler.run(user_id, start_job, on_position=show_position)
+        # Only admitted jobs that ran to the end; rejections and cancels
+        # would otherwise show up as near-zero latencies
+        JOB_SECONDS.observe(time.perf_counter() - started, job=job_type)
+    except asyncio.CancelledError:
+        # Cancelled from the inline button; cancel_action resets the session
+        logger.info(f"Cancelled {job_type} job of user {user_id}")
+    except UserBusyError:
+        msg = await context.bot.send_message(
+            chat_id=user_id,
+            text="⏳ আপনার একটা কাজ ইতিমধ্যে চলছে। শেষ হওয়া পর্যন্ত অপেক্ষা করুন।"
+        )
+        user_data[user_id].setdefault('user_messages', []).append(msg.message_id)
+    except QueueFullError:
+        msg = await context.bot.send_message(
+            chat_id=user_id,
+            text="❌ সার্ভার এখন ব্যস্ত। কিছুক্ষণ পর আবার চেষ্টা করুন।"
+        )
+        user_data[user_id].setdefault('user_messages', []).append(msg.message_id)
+    finally:
+        await progress.close()
+
+# Open a result file for sending: a local Bot API server reads it straight
+# from disk by path, otherwise the file is uploaded
+def open_upload(path):
+    size = os.path.getsize(path)
+    if size > UPLOAD_LIMIT:
+        raise ValueError(f"{path} is {size} bytes, over the {UPLOAD_LIMIT} byte upload limit")
+    if BOT_API_LOCAL:
+        return contextlib.nullcontext(Path(path))
+    return open(path, 'rb')
+
+# Results are streamed from ffmpeg into the upload; a local Bot API server
+# reads finished files by path, so it keeps the file-based path, as do
+# renders handed to workers
+def streaming_delivery():
+    return delivery.STREAM_DELIVERY and not BOT_API_LOCAL and render_queue is None
+
+# Send a merged audio from disk, streamed from `produce` (a coroutine
+# function writing the MP3 to a sink), or by file_id for a cached result
+async def send_merged_audio(context: ContextTypes.DEFAULT_TYPE, user_id, output_path, file_id, caption, duration=None, produce=None):
+    if produce is not None:
+        with stage_timer('upload'):
+            return await delivery.send_stream(
+                context.bot, 'sendAudio', 'audio', 'merged.mp3', produce,
+                chat_id=user_id,
+                duration=round(duration) if duration else None,
+                title="Merged Audio",
+                caption=caption
+            )
+    if output_path is None:
+        return await context.bot.send_audio(
+            chat_id=user_id,
+            audio=file_id,
+            title="Merged Audio",
+            caption=caption
+        )
+    with open_upload(output_path) as audio_file, stage_timer('upload'):
+        return await context.bot.send_audio(
+            chat_id=user_id,
+            audio=audio_file,
+            duration=round(duration) if duration else None,
+            title="Merged Audio",
+            caption=caption
+        )
+
 # Merge audios
 async def merge_audios(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     mode = user_data[user_id]['mode']
     
-    # Check for add_more mode
+    # Check for add_more mode (button_handler checked there are enough files)
     if mode == 'add_more':
-        if len(user_data[user_id]['new_audio_files']) < 1:
-            await update.callback_query.answer("❌ কমপক্ষে ১টা নতুন অডিও পাঠান!", show_alert=True)
-            return
-        
         # Merge with previous file
         await merge_with_previous(update, context)
         return
     
-    # Regular merge mode
-    if len(user_data[user_id]['audio_files']) < 2:
-        await update.callback_query.answer("❌ কমপক্ষে ২টা অডিও পাঠান!", show_alert=True)
-        return
-    
-    await update.callback_query.answer()
-    
     main_msg_id = user_data[user_id]['main_message_id']
+    progress = ProgressReporter(context.bot, user_id, main_msg_id)
+    
+    # An identical merge sent before is answered with its file_id
+    result_key = job_key('merge', *MERGE_SETTINGS, *user_data[user_id]['audio_ids'])
+    cached_result = result_cache.get(result_key)
+    if cached_result and cached_result[1] > RESULT_REUSE_MAX_BYTES:
+        cached_result = None
     
     try:
         # Step 1: Loading audio files (0-30%)
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=main_msg_id,
-            text=f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(10)} 10%\n\n📂 অডিও ফাইল লোড করা হচ্ছে...",
+        progress.update(
+            f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(10)} 10%\n\n📂 অডিও ফাইল লোড করা হচ্ছে...",
+            reply_markup=get_cancel_button(),
             parse_mode='Markdown'
         )
         
-        # Merge all audio files with progress
-        combined = AudioSegment.empty()
+        # Merge all audio files (stream copy when formats match)
         total_files = len(user_data[user_id]['audio_files'])
         
-        for idx, audio_path in enumerate(user_data[user_id]['audio_files']):
-            audio = AudioSegment.from_file(audio_path)
-            combined += audio
-            
-            # Update progress (30% to 70%)
-            progress = 30 + int((idx + 1) / total_files * 40)
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=main_msg_id,
-                text=f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(progress)} {progress}%\n\n🔗 অডিও একত্রিত করা হচ্ছে... ({idx + 1}/{total_files})",
-                parse_mode='Markdown'
-            )
-        
-        # Step 2: Exporting (70-90%)
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=main_msg_id,
-            text=f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(80)} 80%\n\n💾 ফাইল সংরক্ষণ করা হচ্ছে...",
+        progress.update(
+            f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(40)} 40%\n\n🔗 অডিও একত্রিত করা হচ্ছে... ({total_files}টি ফাইল)",
+            reply_markup=get_cancel_button(),
             parse_mode='Markdown'
         )
         
-        # Export merged audio
-        output_path = f"merged_{user_id}.mp3"
-        combined.export(output_path, format="mp3")
+        workspace = get_workspace(user_id)
+        duration = None
+        produce = None
+        if cached_result:
+            output_path = None
+        else:
+            output_path = workspace.path("merged.mp3")
+            with stage_timer('download'):
+                await downloads.wait(user_data[user_id]['audio_files'])
+            duration = await merged_duration(user_data[user_id]['audio_files'])
+            workspace.reserve(workspace.usage())
+            if streaming_delivery():
+                # Encoded while uploading and saved on the way for "add more"
+                audio_files = user_data[user_id]['audio_files']
+                audio_ids = user_data[user_id]['audio_ids']
+                produce = delivery.tee(
+                    lambda sink: concat_audios(audio_files, output_path, cache_keys=audio_ids, sink=sink),
+                    output_path
+                )
+            else:
+                await render('merge', {
+                    'inputs': user_data[user_id]['audio_files'],
+                    'output': output_path,
+                    'cache_keys': user_data[user_id]['audio_ids'],
+                    'duration': duration
+                }, user_id, main_msg_id, show_render_progress(
+                    progress, "অডিও মার্জ করা হচ্ছে...", f"🔗 অডিও একত্রিত করা হচ্ছে... ({total_files}টি ফাইল)"
+                ))
+        
+        # Stop progress updates; the status message is deleted after delivery
+        await progress.close()
         
-        # Step 3: Finalizing (90-100%)
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=main_msg_id,
-            text=f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(100)} 100%\n\n✅ সম্পন্ন হয়েছে!",
-            parse_mode='Markdown'
+        # Send merged audio
+        sent_msg = await send_merged_audio(
+            context, user_id, output_path, cached_result and cached_result[0],
+            f"✅ {len(user_data[user_id]['audio_files'])} টি অডিও একসাথে জোড়া লাগানো হয়েছে!\n\nআরো অডিও যোগ করতে চান?",
+            duration, produce
         )
+        if not cached_result:
+            result_cache.put(result_key, sent_msg.audio.file_id, sent_msg.audio.file_size)
         
-        # Delete all user messages
-        for msg_id in user_data[user_id]['user_messages']:
-            try:
-                await context.bot.delete_message(chat_id=user_id, message_id=msg_id)
-            except:
-                pass
-        
-        # Delete main message
-        try:
-            await context.bot.delete_message(chat_id=user_id, message_id=user_data[user_id]['main_message_id'])
-        except:
-            pass
-        
-        # Send merged audio
-        with open(output_path, 'rb') as audio_file:
-            sent_msg = await context.bot.send_audio(
-                chat_id=user_id,
-                audio=audio_file,
-                title="Merged Audio",
-                caption=f"✅ {len(user_data[user_id]['audio_files'])} টি অডিও একসাথে জোড়া লাগানো হয়েছে!\n\nআরো অডিও যোগ করতে চান?"
-            )
+        # Delete the uploads and the status message now that the result is out
+        message_cleaner.schedule(user_id, user_data[user_id]['user_messages'] + [user_data[user_id]['main_message_id']])
         
         # Send options menu
         options_text = "এখন কি করবেন?"
@@ -833,92 +1113,119 @@ async def merge_audios(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if os.path.exists(audio_path):
                 os.remove(audio_path)
         
-        # Keep merged file for later use
+        # Keep merged file (and its workspace) for later use; a cached
+        # result only exists on Telegram until "add more" needs it
         user_data[user_id] = {
             'main_message_id': options_msg.message_id,
-            'merged_file': output_path
+            'merged_file': output_path,
+            'merged_file_id': sent_msg.audio.file_id,
+            'merged_duration': duration or sent_msg.audio.duration,
+            'result_key': result_key,
+            'workspace': workspace.directory
         }
         
     except Exception as e:
         logger.error(f"Error merging audio: {e}")
+        if cached_result:
+            result_cache.discard(result_key)
         await context.bot.send_message(
             chat_id=user_id,
             text="❌ অডিও মার্জ করতে সমস্যা হয়েছে। আবার চেষ্টা করুন।"
         )
+    finally:
+        await progress.close()
 
 # Merge with previous file
 async def merge_with_previous(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    await update.callback_query.answer()
-    
     main_msg_id = user_data[user_id]['main_message_id']
+    progress = ProgressReporter(context.bot, user_id, main_msg_id)
+    
+    # The same additions to the same previous result were sent before
+    result_key = None
+    cached_result = None
+    if user_data[user_id].get('result_key'):
+        result_key = job_key('add_more', *MERGE_SETTINGS, user_data[user_id]['result_key'], *user_data[user_id]['new_audio_ids'])
+        cached_result = result_cache.get(result_key)
+        if cached_result and cached_result[1] > RESULT_REUSE_MAX_BYTES:
+            cached_result = None
+    
+    # Size of the merged file before this round's append, so a failed round
+    # can be undone and retried
+    base_size = None
     
     try:
         # Load previous merged file
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=main_msg_id,
-            text=f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(10)} 10%\n\n📂 পূর্বের ফাইল লোড করা হচ্ছে...",
+        progress.update(
+            f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(10)} 10%\n\n📂 পূর্বের ফাইল লোড করা হচ্ছে...",
+            reply_markup=get_cancel_button(),
             parse_mode='Markdown'
         )
         
-        combined = AudioSegment.from_file(user_data[user_id]['merged_file'])
-        
-        # Add new audio files
+        # Append only the new audio files to the previous merged file
         total_files = len(user_data[user_id]['new_audio_files'])
         
-        for idx, audio_path in enumerate(user_data[user_id]['new_audio_files']):
-            audio = AudioSegment.from_file(audio_path)
-            combined += audio
-            
-            progress = 30 + int((idx + 1) / total_files * 40)
-            await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=main_msg_id,
-                text=f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(progress)} {progress}%\n\n🔗 নতুন অডিও যোগ করা হচ্ছে... ({idx + 1}/{total_files})",
-                parse_mode='Markdown'
-            )
-        
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=main_msg_id,
-            text=f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(80)} 80%\n\n💾 ফাইল সংরক্ষণ করা হচ্ছে...",
+        progress.update(
+            f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(40)} 40%\n\n🔗 নতুন অডিও যোগ করা হচ্ছে... ({total_files}টি ফাইল)",
+            reply_markup=get_cancel_button(),
             parse_mode='Markdown'
         )
         
-        # Export new merged audio
-        output_path = f"merged_{user_id}.mp3"
-        combined.export(output_path, format="mp3")
+        workspace = get_workspace(user_id)
+        output_path = user_data[user_id].get('merged_file')
+        duration = None
+        produce = None
+        if cached_result:
+            # The local merged file would be stale after this round
+            if output_path and os.path.exists(output_path):
+                os.remove(output_path)
+            output_path = None
+        else:
+            if not output_path or not os.path.exists(output_path):
+                # The previous result was a cached one, fetch it from Telegram
+                output_path = workspace.path("merged.mp3")
+                with stage_timer('download'):
+                    telegram_file = await context.bot.get_file(user_data[user_id]['merged_file_id'])
+                    await fetch_file(telegram_file, output_path, copy=True)
+            with stage_timer('download'):
+                await downloads.wait(user_data[user_id]['new_audio_files'])
+            # The appended file's own duration is only a bitrate estimate
+            previous_duration = user_data[user_id].get('merged_duration') or (await probe_audio(output_path))['duration']
+            duration = previous_duration + await merged_duration(user_data[user_id]['new_audio_files'])
+            base_size = os.path.getsize(output_path)
+            if streaming_delivery():
+                # The previous result is streamed followed by the new audio,
+                # which is appended to it on the way
+                base_path = output_path
+                new_files = user_data[user_id]['new_audio_files']
+                new_ids = user_data[user_id]['new_audio_ids']
+                produce = lambda sink: append_audios(base_path, new_files, new_ids, sink=sink)
+            else:
+                await render('add_more', {
+                    'base': output_path,
+                    'base_size': base_size,
+                    'inputs': user_data[user_id]['new_audio_files'],
+                    'cache_keys': user_data[user_id]['new_audio_ids'],
+                    'duration': duration - previous_duration
+                }, user_id, main_msg_id, show_render_progress(
+                    progress, "অডিও মার্জ করা হচ্ছে...", f"🔗 নতুন অডিও যোগ করা হচ্ছে... ({total_files}টি ফাইল)"
+                ))
+        
+        # Stop progress updates; the status message is deleted after delivery
+        await progress.close()
         
-        await context.bot.edit_message_text(
-            chat_id=user_id,
-            message_id=main_msg_id,
-            text=f"⏳ *অডিও মার্জ করা হচ্ছে...*\n\n{get_progress_bar(100)} 100%\n\n✅ সম্পন্ন হয়েছে!",
-            parse_mode='Markdown'
+        # Send merged audio
+        sent_msg = await send_merged_audio(
+            context, user_id, None if produce else output_path, cached_result and cached_result[0],
+            f"✅ আপডেট সম্পন্ন! {len(user_data[user_id]['new_audio_files'])} টি নতুন অডিও যোগ হয়েছে!",
+            duration, produce
         )
+        if result_key and not cached_result:
+            result_cache.put(result_key, sent_msg.audio.file_id, sent_msg.audio.file_size)
         
-        # Delete user messages
-        for msg_id in user_data[user_id]['user_messages']:
-            try:
-                await context.bot.delete_message(chat_id=user_id, message_id=msg_id)
-            except:
-                pass
-        
-        # Delete main message
-        try:
-            await context.bot.delete_message(chat_id=user_id, message_id=user_data[user_id]['main_message_id'])
-        except:
-            pass
-        
-        # Send merged audio
-        with open(output_path, 'rb') as audio_file:
-            await context.bot.send_audio(
-                chat_id=user_id,
-                audio=audio_file,
-                title="Merged Audio",
-                caption=f"✅ আপডেট সম্পন্ন! {len(user_data[user_id]['new_audio_files'])} টি নতুন অডিও যোগ হয়েছে!"
-            )
+        # Delete the uploads and the status message now that the result is out
+        message_cleaner.schedule(user_id, user_data[user_id]['user_messages'] + [user_data[user_id]['main_message_id']])
         
         # Send options menu
         options_msg = await context.bot.send_message(
@@ -932,77 +1239,104 @@ async def merge_with_previous(update: Update, context: ContextTypes.DEFAULT_TYPE
             if os.path.exists(audio_path):
                 os.remove(audio_path)
         
-        # Delete old merged file
-        if os.path.exists(user_data[user_id]['merged_file']):
-            os.remove(user_data[user_id]['merged_file'])
-        
         # Update user data
         user_data[user_id] = {
             'main_message_id': options_msg.message_id,
-            'merged_file': output_path
+            'merged_file': output_path,
+            'merged_file_id': sent_msg.audio.file_id,
+            'merged_duration': duration or sent_msg.audio.duration,
+            'result_key': result_key,
+            'workspace': workspace.directory
         }
         
     except Exception as e:
         logger.error(f"Error merging with previous: {e}")
+        if cached_result:
+            result_cache.discard(result_key)
+        # The session still lists the new files; drop them from the merged file
+        if base_size is not None and os.path.exists(output_path) and os.path.getsize(output_path) > base_size:
+            os.truncate(output_path, base_size)
         await context.bot.send_message(
             chat_id=user_id,
             text="❌ অডিও মার্জ করতে সমস্যা হয়েছে। আবার চেষ্টা করুন।"
         )
+    finally:
+        await progress.close()
 
 # Create video
 async def create_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Update message - processing
-    await context.bot.edit_message_text(
-        chat_id=user_id,
-        message_id=user_data[user_id]['main_message_id'],
-        text="⏳ ভিডিও বানানো হচ্ছে... অপেক্ষা করুন...",
-        parse_mode='Markdown'
-    )
+    progress = ProgressReporter(context.bot, user_id, user_data[user_id]['main_message_id'])
+    progress.update("⏳ ভিডিও বানানো হচ্ছে... অপেক্ষা করুন...", reply_markup=get_cancel_button(), parse_mode='Markdown')
+    
+    workspace = get_workspace(user_id)
+    output_video = workspace.path("video.mp4")
+    cached_result = None
     
     try:
         image_path = user_data[user_id]['image']
         audio_path = user_data[user_id]['audio']
-        output_video = f"video_{user_id}.mp4"
-        
-        # Get audio duration
-        audio = AudioSegment.from_file(audio_path)
-        duration = len(audio) / 1000  # Convert to seconds
-        
-        # FFmpeg command to create video
-        cmd = [
-            'ffmpeg', '-loop', '1', '-i', image_path,
-            '-i', audio_path,
-            '-c:v', 'libx264', '-tune', 'stillimage',
-            '-c:a', 'aac', '-b:a', '192k',
-            '-pix_fmt', 'yuv420p',
-            '-shortest', '-t', str(duration),
-            '-y', output_video
-        ]
-        
-        subprocess.run(cmd, check=True, capture_output=True)
-        
-        # Delete all user messages
-        for msg_id in user_data[user_id]['user_messages']:
-            try:
-                await context.bot.delete_message(chat_id=user_id, message_id=msg_id)
-except:
-                pass
-        
-        # Delete main message
-        try:
-            await context.bot.delete_message(chat_id=user_id, message_id=user_data[user_id]['main_message_id'])
-        except:
-            pass
+        
+        # The same image and audio were rendered before: resend that video
+        result_key = job_key(
+            'video', user_data[user_id]['image_id'], user_data[user_id]['audio_id'],
+            VIDEO_FPS, VIDEO_GOP, VIDEO_MAX_SIZE, VIDEO_PRESET
+        )
+        cached_result = result_cache.get(result_key)
+        
+        if not cached_result:
+            with stage_timer('download'):
+                await downloads.wait([image_path, audio_path])
+            if not streaming_delivery():
+                workspace.reserve(os.path.getsize(audio_path))
+                
+                # Render with the still-image preset
+                await render('video', {
+                    'image': image_path,
+                    'audio': audio_path,
+                    'output': output_video,
+                    'duration': (await probe_audio(audio_path))['duration']
+                }, user_id, user_data[user_id]['main_message_id'], show_render_progress(
+                    progress, "ভিডিও বানানো হচ্ছে...", "🎬 ভিডিও রেন্ডার করা হচ্ছে..."
+                ))
+        
+        # Stop progress updates; the status message is deleted after delivery
+        await progress.close()
         
         # Send video
-        with open(output_video, 'rb') as video_file:
+        if cached_result:
             await context.bot.send_video(
                 chat_id=user_id,
-                video=video_file,
+                video=cached_result[0],
                 caption="✅ ভিডিও তৈরি সম্পন্ন হয়েছে!"
-            )  
+            )
+        elif streaming_delivery():
+            # Rendered as fragmented MP4 while it is being uploaded
+            duration = (await probe_audio(audio_path))['duration']
+            with stage_timer('upload'):
+                sent_msg = await delivery.send_stream(
+                    context.bot, 'sendVideo', 'video', 'video.mp4',
+                    lambda sink: render_still_video(image_path, audio_path, output_video, sink=sink),
+                    chat_id=user_id,
+                    duration=round(duration) if duration else None,
+                    supports_streaming=True,
+                    caption="✅ ভিডিও তৈরি সম্পন্ন হয়েছে!"
+                )
+            result_cache.put(result_key, sent_msg.video.file_id, sent_msg.video.file_size)
+        else:
+            with open_upload(output_video) as video_file, stage_timer('upload'):
+                sent_msg = await context.bot.send_video(
+                    chat_id=user_id,
+                    video=video_file,
+                    caption="✅ ভিডিও তৈরি সম্পন্ন হয়েছে!"
+                )
+            result_cache.put(result_key, sent_msg.video.file_id, sent_msg.video.file_size)
+        
+        # Delete the uploads and the status message now that the result is out
+        message_cleaner.schedule(user_id, user_data[user_id]['user_messages'] + [user_data[user_id]['main_message_id']])
+        
         # Send main menu again
         welcome_text = """
 🎵 *অডিও ভিডিও বট এ স্বাগতম!* 🎬
@@ -1022,32 +1356,116 @@ except:
             parse_mode='Markdown'
         )
         
-        # Cleanup
-        if os.path.exists(image_path):
-            os.remove(image_path)
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
-        if os.path.exists(output_video):
-            os.remove(output_video)
-        
-        # Reset user data
+        # Reset user data; the inputs are no longer needed
         user_data[user_id] = {'main_message_id': menu_msg.message_id}
+        downloads.cancel_user(user_id)
+        workspace.cleanup()
         
     except Exception as e:
         logger.error(f"Error creating video: {e}")
+        if cached_result:
+            result_cache.discard(result_key)
+        # The image and audio stay in the workspace so a retry can use them
+        if os.path.exists(output_video):
+            os.remove(output_video)
         await context.bot.send_message(
             chat_id=user_id,
             text="❌ ভিডিও বানাতে সমস্যা হয়েছে। আবার চেষ্টা করুন।"
         )
-
-# Main function
-def main():
-    if not TOKEN:
-        logger.error("BOT_TOKEN not found in environment variables!")
-        return
-    
-    # Create application
-    application = Application.builder().token(TOKEN).build()
+    finally:
+        await progress.close()
+
+# Periodically expire idle sessions (their leftover messages are deleted
+# by the message cleaner)
+async def sweep_sessions():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        user_data.expire()
+
+# Periodically write changed sessions to the session backend in one batch
+async def flush_sessions():
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_INTERVAL)
+        try:
+            await user_data.flush()
+        except Exception as e:
+            logger.error(f"Error saving sessions: {e}")
+
+# Start background tasks once the application is initialized
+async def post_init(application: Application):
+    application.bot_data['session_sweeper'] = asyncio.create_task(sweep_sessions())
+    application.bot_data['session_flusher'] = asyncio.create_task(flush_sessions())
+    message_cleaner.start(application.bot)
+    if restored_losses:
+        application.bot_data['loss_notifier'] = asyncio.create_task(notify_restored_losses(application.bot))
+
+# Send queued message deletions while the bot can still reach Telegram
+async def post_stop(application: Application):
+    await message_cleaner.close()
+
+# Stop background tasks and save sessions on shutdown
+async def post_shutdown(application: Application):
+    for name in ('session_sweeper', 'session_flusher'):
+        task = application.bot_data.get(name)
+        if task:
+            task.cancel()
+    await user_data.flush()
+    user_data.backend.close()
+    await delivery.close()
+
+# Users whose restored session lost files, with how many; told once the bot is up
+restored_losses = {}
+
+# Drop the files of a restored session that did not survive the restart
+# (e.g. downloads it cut off) together with their names and IDs, and delete
+# leftover partial downloads; returns how many files were dropped
+def prune_session(session):
+    workspace = session.get('workspace')
+    if workspace and os.path.isdir(workspace):
+        for entry in os.scandir(workspace):
+            if entry.name.endswith('.part'):
+                os.remove(entry.path)
+
+    dropped = 0
+    for path in session_files(session):
+        if not os.path.isfile(path):
+            drop_session_file(session, path)
+            dropped += 1
+    return dropped
+
+# Restore saved sessions, then remove scratch files no session refers to
+def restore_sessions():
+    sessions = user_data.load()
+    for user_id, session in sessions.items():
+        dropped = prune_session(session)
+        if dropped:
+            logger.info(f"Dropped {dropped} missing files from the restored session of user {user_id}")
+            restored_losses[user_id] = dropped
+            # Write the pruned session back
+            user_data[user_id] = session
+    workspaces.sweep(keep=[session.get('workspace') for session in sessions.values()])
+
+# Tell users whose restored file list changed which files to send again
+async def notify_restored_losses(bot):
+    while restored_losses:
+        user_id, dropped = restored_losses.popitem()
+        try:
+            msg = await bot.send_message(
+                chat_id=user_id,
+                text=f"⚠️ বট রিস্টার্ট হওয়ায় আপনার {dropped}টি ফাইল হারিয়ে গেছে, তাই তালিকা থেকে বাদ দেওয়া হয়েছে।\n\nফাইলগুলো আবার পাঠান, তারপর আগের মতো চালিয়ে যান।"
+            )
+        except Exception as e:
+            logger.warning(f"Error notifying user {user_id} about lost files: {e}")
+            continue
+        if user_id in user_data:
+            user_data[user_id].setdefault('user_messages', []).append(msg.message_id)
+
+# Create the application with all handlers
+def build_application():
+    builder = configure_bot_api(Application.builder().token(TOKEN))
+    # Chats are served concurrently, each chat's updates in order
+    builder = builder.concurrent_updates(ChatOrderedUpdateProcessor())
+    application = builder.post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown).build()
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -1056,10 +1474,20 @@ def main():
     application.add_handler(MessageHandler(filters.AUDIO, handle_audio))
     application.add_handler(MessageHandler(filters.VOICE, handle_voice))
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    return application
+
+# Main function (long polling; see server.py for webhook mode)
+def main():
+    if not TOKEN:
+        logger.error("BOT_TOKEN not found in environment variables!")
+        return
+    
+    restore_sessions()
+    application = build_application()
     
     # Start bot
     logger.info("Bot is starting...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
-    main()      
+    main()
@@ -0,0 +1,32 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Self-hosted telegram-bot-api server, e.g. BOT_API_URL=http://localhost:8081/bot.
+# In local mode (the server started with --local) getFile returns absolute
+# paths on a filesystem shared with the bot, and uploads are passed as paths.
+BOT_API_URL = os.getenv('BOT_API_URL')
+BOT_API_FILE_URL = os.getenv('BOT_API_FILE_URL')
+BOT_API_LOCAL = os.getenv('BOT_API_LOCAL', '1' if BOT_API_URL else '0') == '1'
+
+# Largest files the Bot API lets the bot download and upload
+if BOT_API_LOCAL:
+    DOWNLOAD_LIMIT = int(os.getenv('DOWNLOAD_LIMIT_MB', 2000)) * MB
+    UPLOAD_LIMIT = int(os.getenv('UPLOAD_LIMIT_MB', 2000)) * MB
+else:
+    DOWNLOAD_LIMIT = int(os.getenv('DOWNLOAD_LIMIT_MB', 20)) * MB
+    UPLOAD_LIMIT = int(os.getenv('UPLOAD_LIMIT_MB', 50)) * MB
+
+# Point an ApplicationBuilder at the configured Bot API server
+def configure(builder):
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+        if BOT_API_FILE_URL:
+            builder = builder.base_file_url(BOT_API_FILE_URL)
+        logger.info(f"Using Bot API server {BOT_API_URL} (local mode: {BOT_API_LOCAL})")
+    if BOT_API_LOCAL:
+        builder = builder.local_mode(True)
+    return builder
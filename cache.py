@@ -0,0 +1,166 @@
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+from botapi import DOWNLOAD_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Input cache location and size; kept outside the scratch root so the
+# startup sweep leaves it alone
+INPUT_CACHE_DIR = os.getenv('INPUT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'avbot-cache'))
+INPUT_CACHE_BYTES = int(os.getenv('INPUT_CACHE_MB', 2048)) * 1024 * 1024
+
+# Hard-link a file, falling back to a copy across filesystems
+def link_or_copy(source, dest):
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copyfile(source, dest)
+
+# Size-bounded LRU of files on disk, keyed by Telegram file_unique_id (and,
+# for normalized intermediates, the unique id plus a format suffix)
+class InputCache:
+    def __init__(self, root=INPUT_CACHE_DIR, max_bytes=INPUT_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+        os.makedirs(root, exist_ok=True)
+        # Rebuild the LRU order from modification times
+        entries = sorted(os.scandir(root), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if entry.name.endswith('.part'):
+                os.remove(entry.path)
+                continue
+            self._entries[entry.name] = entry.stat().st_size
+            self._size += entry.stat().st_size
+
+    def _path(self, key):
+        return os.path.join(self.root, os.path.basename(key))
+
+    # Put the cached file for `key` at `dest`; returns False on a miss
+    def fetch(self, key, dest):
+        with self._lock:
+            size = self._entries.get(key)
+            if size is None:
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += size
+
+        try:
+            link_or_copy(self._path(key), dest)
+            os.utime(self._path(key))
+        except OSError as e:
+            logger.warning(f"Error reading cached input {key}: {e}")
+            with self._lock:
+                self._discard(key)
+            return False
+        return True
+
+    # Add a copy of `source` under `key`, evicting least recently used entries
+    def store(self, key, source):
+        size = os.path.getsize(source)
+        if size > self.max_bytes:
+            return
+
+        part_path = self._path(key) + '.part'
+        link_or_copy(source, part_path)
+        os.replace(part_path, self._path(key))
+
+        with self._lock:
+            self._discard(key, remove_file=False)
+            self._entries[key] = size
+            self._size += size
+            while self._size > self.max_bytes and self._entries:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, key, remove_file=True):
+        size = self._entries.pop(key, None)
+        if size is None:
+            return
+        self._size -= size
+        if remove_file and os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_saved': self.bytes_saved,
+            'entries': len(self._entries),
+            'bytes': self._size
+        }
+
+input_cache = InputCache()
+
+# Results are only reused for merges when they can be downloaded again for
+# a later "add more" round (Bot API getFile limit)
+RESULT_REUSE_MAX_BYTES = int(os.getenv('RESULT_REUSE_MAX_MB', DOWNLOAD_LIMIT // (1024 * 1024))) * 1024 * 1024
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 10000))
+RESULT_CACHE_DB = os.getenv('RESULT_CACHE_DB')
+
+# Stable hash of a job's inputs and parameters
+def job_key(*parts):
+    return hashlib.sha256('\x1f'.join(str(part) for part in parts).encode()).hexdigest()
+
+# Maps job keys to the Telegram file_id (and size) of the output sent for
+# that job, so identical jobs are answered without encoding or uploading.
+# Persisted in SQLite when RESULT_CACHE_DB is set.
+class ResultCache:
+    def __init__(self, path=RESULT_CACHE_DB, max_size=RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, file_id TEXT NOT NULL, file_size INTEGER, updated REAL NOT NULL)'
+            )
+            rows = self._conn.execute(
+                'SELECT key, file_id, file_size FROM results ORDER BY updated DESC LIMIT ?', (max_size,)
+            ).fetchall()
+            for key, file_id, file_size in reversed(rows):
+                self._entries[key] = (file_id, file_size)
+
+    # (file_id, file_size) of an earlier identical job, or None
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, file_id, file_size):
+        self._entries[key] = (file_id, file_size)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        if self._conn is not None:
+            with self._conn:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                    (key, file_id, file_size, time.time())
+                )
+
+    # Forget a file_id Telegram no longer accepts
+    def discard(self, key):
+        self._entries.pop(key, None)
+        if self._conn is not None:
+            with self._conn:
+                self._conn.execute('DELETE FROM results WHERE key = ?', (key,))
+
+result_cache = ResultCache()
@@ -0,0 +1,77 @@
+import os
+import asyncio
+import logging
+
+from telegram.error import RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Most message IDs one deleteMessages call accepts
+DELETE_BATCH = 100
+
+# Upper bound on deleteMessages calls per second across all chats
+CLEANUP_RATE = float(os.getenv('CLEANUP_RATE', 10))
+
+# Deletes leftover chat messages (uploads, hints, status messages) in the
+# background. schedule() only records IDs; a single task sends them with
+# deleteMessages in batches of up to 100 per chat, paced by CLEANUP_RATE
+# and backing off when Telegram asks to retry later.
+class MessageCleaner:
+    def __init__(self, rate=CLEANUP_RATE):
+        self.rate = rate
+        self._bot = None
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    # Queue messages of a chat for deletion (safe to call before start())
+    def schedule(self, chat_id, message_ids):
+        message_ids = [msg_id for msg_id in message_ids if msg_id]
+        if not message_ids:
+            return
+        pending = self._pending.setdefault(chat_id, [])
+        pending.extend(msg_id for msg_id in message_ids if msg_id not in pending)
+        self._wakeup.set()
+
+    def start(self, bot):
+        self._bot = bot
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self._drain()
+
+    async def _drain(self):
+        while self._pending:
+            chat_id = next(iter(self._pending))
+            message_ids = self._pending.pop(chat_id)
+            batch, rest = message_ids[:DELETE_BATCH], message_ids[DELETE_BATCH:]
+            if rest:
+                self.schedule(chat_id, rest)
+            try:
+                await self._bot.delete_messages(chat_id=chat_id, message_ids=batch)
+            except RetryAfter as e:
+                self.schedule(chat_id, batch)
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramError as e:
+                # e.g. messages older than 48 hours; nothing left to do
+                logger.warning(f"Error deleting {len(batch)} messages in chat {chat_id}: {e}")
+            await asyncio.sleep(1 / self.rate)
+
+    # Stop the background task; with flush=True queued deletions are sent first
+    async def close(self, flush=True):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if flush and self._bot is not None:
+            await self._drain()
+
+message_cleaner = MessageCleaner()
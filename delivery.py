@@ -0,0 +1,126 @@
+import os
+import json
+import uuid
+import asyncio
+import logging
+
+import httpx
+from telegram import Message
+from telegram.error import TelegramError
+
+from botapi import UPLOAD_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Upload results while ffmpeg is still writing them instead of going
+# through a file in the workspace
+STREAM_DELIVERY = os.getenv('STREAM_DELIVERY', '0') == '1'
+
+# Encoder output chunks buffered ahead of the upload; a slow upload makes
+# the encoder wait instead of growing memory
+STREAM_BUFFER_CHUNKS = int(os.getenv('STREAM_BUFFER_CHUNKS', 64))
+
+# Upload timeouts in seconds; writing may stall as long as the encoder does
+UPLOAD_TIMEOUT = httpx.Timeout(connect=20, read=300, write=300, pool=20)
+
+class UploadTooLargeError(Exception):
+    pass
+
+_client = None
+
+def _get_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=UPLOAD_TIMEOUT)
+    return _client
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# Wrap a producer for send_stream so everything it uploads is also saved at `path`
+def tee(produce, path):
+    async def produce_and_save(sink):
+        with open(path, 'wb') as output:
+            async def save(chunk):
+                await asyncio.to_thread(output.write, chunk)
+                await sink(chunk)
+            return await produce(save)
+    return produce_and_save
+
+def _form_part(boundary, name, value=None, filename=None):
+    disposition = f'form-data; name="{name}"'
+    if filename:
+        disposition += f'; filename="{filename}"'
+    head = f'--{boundary}\r\nContent-Disposition: {disposition}\r\n'
+    if filename:
+        head += 'Content-Type: application/octet-stream\r\n'
+    head += '\r\n'
+    if value is None:
+        return head.encode()
+    return (head + f'{value}\r\n').encode()
+
+# Call a Bot API upload method (sendAudio, sendVideo, ...) with the file
+# field fed by `produce`, a coroutine function taking an async sink. The
+# producer runs concurrently and the request body is sent with chunked
+# transfer encoding as its chunks arrive. Returns the sent Message.
+async def send_stream(bot, method, field, filename, produce, max_bytes=UPLOAD_LIMIT, **params):
+    queue = asyncio.Queue(STREAM_BUFFER_CHUNKS)
+    sent = 0
+
+    async def sink(chunk):
+        nonlocal sent
+        sent += len(chunk)
+        if sent > max_bytes:
+            raise UploadTooLargeError(f"Result exceeds {max_bytes} bytes")
+        await queue.put(chunk)
+
+    producer = asyncio.create_task(produce(sink))
+    boundary = uuid.uuid4().hex
+
+    async def body():
+        for name, value in params.items():
+            if value is None:
+                continue
+            if not isinstance(value, str):
+                value = json.dumps(value)
+            yield _form_part(boundary, name, value)
+        yield _form_part(boundary, field, filename=filename)
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait({getter, producer}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield getter.result()
+                continue
+            getter.cancel()
+            # The producer finished: send what it left in the queue, or
+            # abort the request with its error
+            producer.result()
+            while not queue.empty():
+                yield queue.get_nowait()
+            break
+        yield f'\r\n--{boundary}--\r\n'.encode()
+
+    try:
+        response = await _get_client().post(
+            f"{bot.base_url}/{method}",
+            content=body(),
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        )
+    except BaseException:
+        producer.cancel()
+        try:
+            await producer
+        except BaseException:
+            pass
+        raise
+    # Surface encoder errors before upload errors
+    await producer
+
+    data = response.json()
+    if not data.get('ok'):
+        raise TelegramError(data.get('description', f"{method} failed with HTTP {response.status_code}"))
+    logger.info(f"Streamed {sent} bytes with {method}")
+    return Message.de_json(data['result'], bot)
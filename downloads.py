@@ -0,0 +1,116 @@
+import os
+import shutil
+import asyncio
+import logging
+
+from cache import input_cache, link_or_copy
+from metrics import DOWNLOAD_SECONDS
+from workspace import workspaces
+
+logger = logging.getLogger(__name__)
+
+# How many files one user may download at the same time
+DOWNLOADS_PER_USER = int(os.getenv('DOWNLOADS_PER_USER', 3))
+
+# Save a Telegram File at `path`. Behind a local Bot API server the file is
+# already on this machine, so it is hard-linked instead of downloaded; pass
+# copy=True for files that will be modified in place.
+async def fetch_file(telegram_file, path, copy=False):
+    source = telegram_file.file_path
+    if source and os.path.isabs(source) and os.path.isfile(source):
+        if copy:
+            await asyncio.to_thread(shutil.copyfile, source, path)
+        else:
+            await asyncio.to_thread(link_or_copy, source, path)
+    else:
+        await telegram_file.download_to_drive(path)
+
+# Fetches uploaded files in the background as soon as their message arrives.
+# Downloads are keyed by destination path; jobs wait() for the paths they
+# need, so most inputs are already local when the user presses "done".
+# Files already in the input cache (same file_unique_id) are not downloaded.
+class DownloadManager:
+    def __init__(self, per_user=DOWNLOADS_PER_USER, cache=input_cache):
+        self.per_user = per_user
+        self.cache = cache
+        self._pending = {}
+        self._owners = {}
+        self._limits = {}
+
+    # Start downloading a Telegram attachment (Audio, Voice, Document,
+    # PhotoSize) to `path`; returns the download task. Its size counts
+    # against the scratch quota until the download ends.
+    def start(self, user_id, attachment, path):
+        workspaces.hold(user_id, path, attachment.file_size)
+        if user_id not in self._limits:
+            self._limits[user_id] = asyncio.Semaphore(self.per_user)
+        task = asyncio.get_running_loop().create_task(self._download(user_id, attachment, path))
+        self._pending[path] = task
+        self._owners[path] = user_id
+        task.add_done_callback(lambda done: self._finished(path, done))
+        return task
+
+    async def _download(self, user_id, attachment, path):
+        unique_id = attachment.file_unique_id
+        if self.cache is not None and await asyncio.to_thread(self.cache.fetch, unique_id, path):
+            return path
+
+        async with self._limits[user_id]:
+            # Write under a temporary name so a partial file is never used
+            part_path = f"{path}.part"
+            try:
+                with DOWNLOAD_SECONDS.time():
+                    telegram_file = await attachment.get_file()
+                    await fetch_file(telegram_file, part_path)
+                os.replace(part_path, path)
+            finally:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+
+        if self.cache is not None:
+            try:
+                await asyncio.to_thread(self.cache.store, unique_id, path)
+            except OSError as e:
+                logger.warning(f"Error caching {path}: {e}")
+        return path
+
+    def _finished(self, path, task):
+        workspaces.release(path)
+        if self._pending.get(path) is not task:
+            return
+        if task.cancelled() or task.exception() is None:
+            del self._pending[path]
+            self._forget(path)
+        else:
+            # Failed downloads stay pending so wait() reports the error
+            logger.error(f"Error downloading {path}: {task.exception()}")
+
+    def _forget(self, path):
+        user_id = self._owners.pop(path, None)
+        if user_id is not None and user_id not in self._owners.values():
+            self._limits.pop(user_id, None)
+
+    # Wait until every given path has finished downloading; raises the
+    # first download error
+    async def wait(self, paths):
+        tasks = [self._pending[path] for path in paths if path in self._pending]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for path in paths:
+                task = self._pending.get(path)
+                if task is not None and task.done():
+                    del self._pending[path]
+                    self._forget(path)
+
+    # Abort every pending download of a user
+    def cancel_user(self, user_id):
+        for path, owner in list(self._owners.items()):
+            if owner != user_id:
+                continue
+            task = self._pending.pop(path, None)
+            if task is not None:
+                task.cancel()
+            self._forget(path)
+
+downloads = DownloadManager()
@@ -0,0 +1,177 @@
+import os
+import signal
+import asyncio
+import logging
+import tempfile
+import subprocess
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Seconds a cancelled job gets to kill its processes and release its slot
+# before the cancel returns anyway
+JOB_CANCEL_TIMEOUT = float(os.getenv('JOB_CANCEL_TIMEOUT', 10))
+
+# Directory the ffmpeg processes of the current task write `-progress`
+# reports to, one file per process (set by render workers); None disables
+progress_dir = contextvars.ContextVar('progress_dir', default=None)
+
+def _with_progress(cmd):
+    directory = progress_dir.get()
+    if directory is None or os.path.basename(cmd[0]) != 'ffmpeg':
+        return cmd
+    fd, path = tempfile.mkstemp(suffix='.progress', dir=directory)
+    os.close(fd)
+    return [cmd[0], '-progress', f'file:{path}', '-nostats'] + list(cmd[1:])
+
+# Start a child process in its own process group so that cancelling a job
+# can kill it together with anything it spawned
+async def start_process(cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE):
+    return await asyncio.create_subprocess_exec(
+        *_with_progress(cmd), stdin=stdin, stdout=stdout, stderr=stderr, start_new_session=True
+    )
+
+# Kill a process started by start_process and its whole group
+def kill_process(process):
+    if process is not None and process.returncode is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+# Runs ffmpeg processes and blocking file operations outside the event loop,
+# with at most `slots` media jobs in flight at once
+class MediaExecutor:
+    def __init__(self, slots=None):
+        self.slots = slots or int(os.getenv('MEDIA_WORKERS', 0)) or os.cpu_count() or 1
+        self._semaphore = asyncio.Semaphore(self.slots)
+        self._pool = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix='media')
+
+    # Run a command and return its stdout, raising CalledProcessError on failure
+    async def run_process(self, cmd):
+        async with self._semaphore:
+            process = await start_process(cmd)
+            try:
+                stdout, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                kill_process(process)
+                await process.wait()
+                raise
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+        return stdout
+
+    # Hold one slot while driving several processes directly
+    def slot(self):
+        return self._semaphore
+
+    # Run a blocking function in the worker pool
+    async def run_blocking(self, func, *args):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, func, *args)
+
+media_executor = MediaExecutor()
+
+# Raised when the wait queue is full and a new job cannot be admitted
+class QueueFullError(Exception):
+    pass
+
+# Raised when the user already has a job running or waiting
+class UserBusyError(Exception):
+    pass
+
+# Admits merge/video jobs: a global cap on running jobs, one job per user
+# and a bounded FIFO of waiting jobs
+class JobScheduler:
+    def __init__(self, max_active=None, max_queued=None):
+        self.max_active = max_active or int(os.getenv('MAX_ACTIVE_JOBS', 0)) or media_executor.slots
+        self.max_queued = max_queued if max_queued is not None else int(os.getenv('MAX_QUEUED_JOBS', 20))
+        self._active = set()
+        self._waiting = []
+        self._notify_tasks = set()
+        # user_id -> task running or waiting for the user's job
+        self._tasks = {}
+
+    @property
+    def active_count(self):
+        return len(self._active)
+
+    @property
+    def queue_depth(self):
+        return len(self._waiting)
+
+    def is_busy(self, user_id):
+        return user_id in self._active or any(entry[0] == user_id for entry in self._waiting)
+
+    # Wait for a slot, then run `job()`; `on_position(n)` is called whenever
+    # the user's place in the queue changes
+    async def run(self, user_id, job, on_position=None):
+        if self.is_busy(user_id):
+            raise UserBusyError(user_id)
+
+        self._tasks[user_id] = asyncio.current_task()
+        try:
+            return await self._run(user_id, job, on_position)
+        finally:
+            del self._tasks[user_id]
+
+    async def _run(self, user_id, job, on_position):
+        if self._waiting or len(self._active) >= self.max_active:
+            if len(self._waiting) >= self.max_queued:
+                raise QueueFullError()
+
+            entry = (user_id, asyncio.get_running_loop().create_future(), on_position)
+            self._waiting.append(entry)
+            self._notify_positions()
+            try:
+                await entry[1]
+            except asyncio.CancelledError:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    self._notify_positions()
+                else:
+                    # The slot was handed over right before the cancel landed
+                    self._release(user_id)
+                raise
+        else:
+            self._active.add(user_id)
+
+        try:
+            return await job()
+        finally:
+            self._release(user_id)
+
+    # Cancel the user's job, waiting or running, and wait until it has wound
+    # down (processes killed, downloads aborted, slot released); returns
+    # False when the user had no job
+    async def cancel(self, user_id, timeout=JOB_CANCEL_TIMEOUT):
+        task = self._tasks.get(user_id)
+        if task is None or task is asyncio.current_task():
+            return False
+        logger.info(f"Cancelling the job of user {user_id}")
+        task.cancel()
+        await asyncio.wait({task}, timeout=timeout)
+        return True
+
+    def _release(self, user_id):
+        self._active.discard(user_id)
+        while self._waiting and len(self._active) < self.max_active:
+            next_user_id, future, _ = self._waiting.pop(0)
+            if future.done():
+                continue
+            self._active.add(next_user_id)
+            future.set_result(None)
+        self._notify_positions()
+
+    def _notify_positions(self):
+        for position, (_, _, on_position) in enumerate(self._waiting, start=1):
+            if on_position is None:
+                continue
+            task = asyncio.get_running_loop().create_task(on_position(position))
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+job_scheduler = JobScheduler()
@@ -0,0 +1,531 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import shutil
+import tempfile
+import subprocess
+from fractions import Fraction
+from collections import OrderedDict
+
+from jobs import media_executor, start_process, kill_process
+from cache import input_cache
+from metrics import STAGE_SECONDS, current_job, stage_timer
+
+logger = logging.getLogger(__name__)
+
+# Codecs that can be stream-copied into the merged MP3 output
+COPYABLE_CODECS = {'mp3'}
+
+# Encoder settings used whenever the merged audio has to be re-encoded
+MP3_ENCODE_ARGS = ['-c:a', 'libmp3lame', '-b:a', '192k']
+
+# When formats differ, encode each odd input once to the merge format and
+# keep that normalized copy in the input cache, then stream-copy concat
+NORMALIZE_INPUTS = os.getenv('INPUT_CACHE_NORMALIZE', '0') == '1'
+
+# Optional effects applied by the streaming merge: fade in/out of every
+# segment and silence between segments (milliseconds)
+MERGE_FADE_MS = int(os.getenv('MERGE_FADE_MS', 0))
+MERGE_GAP_MS = int(os.getenv('MERGE_GAP_MS', 0))
+
+# Bytes moved per read from a decoder to the encoder; this buffer is all
+# the PCM the bot holds, however long or many the inputs are
+STREAM_CHUNK = 64 * 1024
+
+# Bytes of an ffmpeg process's stderr kept for its error message
+STDERR_TAIL = 16 * 1024
+
+# Write merged MP3s as a bare frame stream (no ID3 tags, no Xing header) so
+# later rounds can append new frames to the end of the file
+MP3_STREAM_ARGS = ['-write_xing', '0', '-id3v2_version', '0', '-write_id3v1', '0']
+
+# Probe results keyed by (path, size, mtime) so a rewritten file is re-probed
+PROBE_CACHE_SIZE = int(os.getenv('PROBE_CACHE_SIZE', 512))
+_probe_cache = OrderedDict()
+
+# Read duration, codec, sample rate and channel count of the first audio
+# stream from the container headers, without decoding any audio
+async def probe_audio(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key in _probe_cache:
+        _probe_cache.move_to_end(key)
+        return _probe_cache[key]
+
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'a:0',
+        '-show_entries', 'stream=codec_name,sample_rate,channels,duration:format=duration',
+        '-of', 'json', path
+    ]
+    with stage_timer('decode'):
+        stdout = await media_executor.run_process(cmd)
+    data = json.loads(stdout or b'{}')
+    stream = (data.get('streams') or [{}])[0]
+    duration = data.get('format', {}).get('duration') or stream.get('duration')
+    info = {
+        'duration': float(duration or 0),
+        'codec': stream.get('codec_name'),
+        'sample_rate': int(stream.get('sample_rate') or 0),
+        'channels': int(stream.get('channels') or 0)
+    }
+
+    _probe_cache[key] = info
+    while len(_probe_cache) > PROBE_CACHE_SIZE:
+        _probe_cache.popitem(last=False)
+    return info
+
+# True when every input can be joined by the concat demuxer without
+# re-encoding (and matches the requested target format, if any)
+def can_stream_copy(infos, sample_rate=None, channels=None):
+    first = infos[0]
+    if first['codec'] not in COPYABLE_CODECS:
+        return False
+    if sample_rate and first['sample_rate'] != sample_rate:
+        return False
+    if channels and first['channels'] != channels:
+        return False
+    return all(
+        info['codec'] == first['codec'] and
+        info['sample_rate'] == first['sample_rate'] and
+        info['channels'] == first['channels']
+        for info in infos
+    )
+
+# Quote a path for an ffmpeg concat list file
+def _concat_entry(path):
+    escaped = os.path.abspath(path).replace("'", "'\\''")
+    return f"file '{escaped}'\n"
+
+# Output arguments: the file at `output_path`, or stdout in `fmt` when the
+# result is streamed (output_path None)
+def _output_args(output_path, fmt):
+    if output_path is None:
+        return ['-f', fmt, 'pipe:1']
+    return ['-y', output_path]
+
+# ffmpeg command joining inputs through the concat demuxer with stream copy
+def build_copy_concat_command(list_path, output_path):
+    return [
+        'ffmpeg', '-v', 'error',
+        '-f', 'concat', '-safe', '0', '-i', list_path,
+        '-map', '0:a', '-c:a', 'copy'
+    ] + MP3_STREAM_ARGS + _output_args(output_path, 'mp3')
+
+# ffmpeg command decoding one input to raw PCM on stdout, with optional
+# gain (dB) and fades (ms)
+def build_pcm_decode_command(input_path, sample_rate, channels, gain_db=0, fade_ms=0, duration=0):
+    filters = []
+    if gain_db:
+        filters.append(f'volume={gain_db}dB')
+    if fade_ms:
+        fade = fade_ms / 1000
+        filters.append(f'afade=t=in:d={fade}')
+        if duration > fade:
+            filters.append(f'afade=t=out:st={duration - fade:.3f}:d={fade}')
+
+    cmd = ['ffmpeg', '-v', 'error', '-i', input_path, '-map', '0:a:0']
+    if filters:
+        cmd += ['-af', ','.join(filters)]
+    cmd += ['-f', 's16le', '-ar', str(sample_rate), '-ac', str(channels), 'pipe:1']
+    return cmd
+
+# ffmpeg command encoding raw PCM from stdin to the merged MP3
+def build_pcm_encode_command(output_path, sample_rate, channels):
+    return [
+        'ffmpeg', '-v', 'error',
+        '-f', 's16le', '-ar', str(sample_rate), '-ac', str(channels), '-i', 'pipe:0'
+    ] + MP3_ENCODE_ARGS + MP3_STREAM_ARGS + _output_args(output_path, 'mp3')
+
+# Read a process's stderr while it runs, so a noisy ffmpeg (a damaged
+# input can print an error for every frame) never blocks on a full pipe;
+# the task returns the last STDERR_TAIL bytes
+def _collect_stderr(process):
+    async def collect():
+        tail = b''
+        while True:
+            chunk = await process.stderr.read(STREAM_CHUNK)
+            if not chunk:
+                return tail
+            tail = (tail + chunk)[-STDERR_TAIL:]
+    return asyncio.create_task(collect())
+
+# Wait for a process to exit, raising CalledProcessError with the stderr
+# tail from `errors` (a _collect_stderr task) when it failed
+async def _check_process(process, cmd, errors):
+    stderr = await errors
+    if await process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, None, stderr)
+
+# Kill processes and their groups; the event loop reaps them (waiting here
+# could hang on a decoder whose unread stdout keeps its pipe open)
+def _kill(*processes):
+    for process in processes:
+        kill_process(process)
+
+# Hand a process's stdout to `sink` chunk by chunk
+async def _drain_to_sink(process, sink):
+    while True:
+        chunk = await process.stdout.read(STREAM_CHUNK)
+        if not chunk:
+            break
+        await sink(chunk)
+
+# Run an ffmpeg command, writing its output to a file or, when `sink` is
+# given, streaming its stdout to the sink
+async def _run_output(cmd, sink=None):
+    if sink is None:
+        await media_executor.run_process(cmd)
+        return
+    async with media_executor.slot():
+        process = await start_process(cmd)
+        errors = _collect_stderr(process)
+        try:
+            await _drain_to_sink(process, sink)
+            await _check_process(process, cmd, errors)
+        except BaseException:
+            errors.cancel()
+            _kill(process)
+            raise
+
+# Decode inputs one after another and pipe their PCM through a fixed-size
+# buffer into a single encoder, so memory stays flat for 3 or 300 inputs.
+# `gains` holds one dB value per input; fades and gaps are in milliseconds.
+# With a `sink` the encoded MP3 is streamed to it instead of output_path.
+async def stream_merge(input_paths, output_path, sample_rate=None, channels=None,
+                       gains=None, fade_ms=MERGE_FADE_MS, gap_ms=MERGE_GAP_MS, infos=None, sink=None):
+    infos = infos or await asyncio.gather(*(probe_audio(path) for path in input_paths))
+    sample_rate = sample_rate or infos[0]['sample_rate'] or 44100
+    channels = channels or infos[0]['channels'] or 2
+    gains = gains or [0] * len(input_paths)
+    frame_size = 2 * channels
+    gap_bytes = int(sample_rate * gap_ms / 1000) * frame_size
+
+    encode_cmd = build_pcm_encode_command(None if sink else output_path, sample_rate, channels)
+    encoder = None
+    decoder = None
+    errors = []
+    pump = None
+    decode_time = 0
+    start = time.perf_counter()
+    async with media_executor.slot():
+        try:
+            encoder = await start_process(
+                encode_cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE if sink else asyncio.subprocess.DEVNULL
+            )
+            encoder_errors = _collect_stderr(encoder)
+            errors.append(encoder_errors)
+            if sink:
+                pump = asyncio.create_task(_drain_to_sink(encoder, sink))
+            for index, (path, info, gain_db) in enumerate(zip(input_paths, infos, gains)):
+                if index and gap_bytes:
+                    silence = bytes(min(gap_bytes, STREAM_CHUNK))
+                    for offset in range(0, gap_bytes, len(silence)):
+                        encoder.stdin.write(silence[:gap_bytes - offset])
+                        await encoder.stdin.drain()
+
+                decode_cmd = build_pcm_decode_command(path, sample_rate, channels, gain_db, fade_ms, info['duration'])
+                decode_start = time.perf_counter()
+                decoder = await start_process(decode_cmd)
+                decoder_errors = _collect_stderr(decoder)
+                errors.append(decoder_errors)
+                while True:
+                    chunk = await decoder.stdout.read(STREAM_CHUNK)
+                    if not chunk:
+                        break
+                    encoder.stdin.write(chunk)
+                    await encoder.stdin.drain()
+                await _check_process(decoder, decode_cmd, decoder_errors)
+                decoder = None
+                decode_time += time.perf_counter() - decode_start
+
+            encoder.stdin.close()
+            if pump:
+                await pump
+            await _check_process(encoder, encode_cmd, encoder_errors)
+        except BaseException:
+            if pump:
+                pump.cancel()
+            for task in errors:
+                task.cancel()
+            _kill(decoder, encoder)
+            raise
+
+    # The encoder runs for the whole pipeline, the decoders one after another
+    STAGE_SECONDS.observe(decode_time, job=current_job.get(), stage='decode')
+    STAGE_SECONDS.observe(time.perf_counter() - start, job=current_job.get(), stage='encode')
+
+    return output_path
+
+# ffmpeg command encoding one input to the merge format
+def build_normalize_command(input_path, output_path, sample_rate, channels):
+    return [
+        'ffmpeg', '-v', 'error', '-i', input_path,
+        '-map', '0:a:0'
+    ] + MP3_ENCODE_ARGS + [
+        '-ar', str(sample_rate), '-ac', str(channels)
+    ] + MP3_STREAM_ARGS + ['-y', output_path]
+
+# `work_dir` holds the concat list; the result goes to output_path or `sink`
+async def _copy_concat(input_paths, output_path, work_dir, sink=None):
+    list_dir = work_dir
+    fd, list_path = tempfile.mkstemp(suffix='.txt', dir=list_dir)
+    try:
+        with os.fdopen(fd, 'w') as list_file:
+            list_file.writelines(_concat_entry(path) for path in input_paths)
+        with stage_timer('encode'):
+            await _run_output(build_copy_concat_command(list_path, None if sink else output_path), sink)
+    finally:
+        if os.path.exists(list_path):
+            os.remove(list_path)
+
+# Get a normalized MP3 of one input into `dest`, from the cache when possible
+async def _normalized_input(path, cache_key, dest, sample_rate, channels):
+    key = f"{cache_key}.{sample_rate}-{channels}.mp3"
+    if await asyncio.to_thread(input_cache.fetch, key, dest):
+        return dest
+    with stage_timer('encode'):
+        await media_executor.run_process(build_normalize_command(path, dest, sample_rate, channels))
+    await asyncio.to_thread(input_cache.store, key, dest)
+    return dest
+
+# Normalize the inputs that don't match the merge format, then stream-copy
+async def _concat_normalized(input_paths, infos, output_path, sample_rate, channels, cache_keys, sink=None):
+    sample_rate = sample_rate or infos[0]['sample_rate'] or 44100
+    channels = channels or infos[0]['channels'] or 2
+    work_dir = os.path.dirname(os.path.abspath(output_path))
+    sources = list(input_paths)
+    pending = {}
+    for index, (path, info, cache_key) in enumerate(zip(input_paths, infos, cache_keys)):
+        if not can_stream_copy([info], sample_rate, channels):
+            dest = os.path.join(work_dir, f"normalized_{index}.mp3")
+            pending[index] = _normalized_input(path, cache_key, dest, sample_rate, channels)
+
+    try:
+        for index, dest in zip(pending, await asyncio.gather(*pending.values())):
+            sources[index] = dest
+        await _copy_concat(sources, output_path, work_dir, sink)
+    finally:
+        for index in pending:
+            dest = os.path.join(work_dir, f"normalized_{index}.mp3")
+            if os.path.exists(dest):
+                os.remove(dest)
+    return output_path
+
+# Merge audio files into one MP3, stream-copying when the formats allow it
+# and no effects are requested, otherwise through the streaming pipeline.
+# `cache_keys` (the inputs' file_unique_ids) enable normalized-input caching.
+# With a `sink` (async callable taking bytes) the MP3 is streamed to it and
+# output_path only marks the directory for intermediate files.
+async def concat_audios(input_paths, output_path, sample_rate=None, channels=None, cache_keys=None,
+                        gains=None, fade_ms=MERGE_FADE_MS, gap_ms=MERGE_GAP_MS, sink=None):
+    infos = await asyncio.gather(*(probe_audio(path) for path in input_paths))
+    effects = any(gains or []) or fade_ms or gap_ms
+
+    if effects or not can_stream_copy(infos, sample_rate, channels):
+        if not effects and NORMALIZE_INPUTS and cache_keys and len(cache_keys) == len(input_paths):
+            logger.info(f"Merging {len(input_paths)} files with cached normalization")
+            return await _concat_normalized(input_paths, infos, output_path, sample_rate, channels, cache_keys, sink)
+
+        logger.info(f"Merging {len(input_paths)} files with streaming re-encode")
+        return await stream_merge(input_paths, output_path, sample_rate, channels, gains, fade_ms, gap_ms, infos, sink)
+
+    logger.info(f"Merging {len(input_paths)} files with stream copy")
+    await _copy_concat(input_paths, output_path, os.path.dirname(os.path.abspath(output_path)), sink)
+    return output_path
+
+# Playing time of the inputs once merged, gaps included. Merged MP3s carry
+# no Xing header, so ffprobe can only estimate their duration from the
+# bitrate; the sum of the inputs' durations is exact.
+async def merged_duration(input_paths, gap_ms=MERGE_GAP_MS):
+    infos = await asyncio.gather(*(probe_audio(path) for path in input_paths))
+    return sum(info['duration'] for info in infos) + gap_ms * max(len(infos) - 1, 0) / 1000
+
+def _append_file(source_path, target_path):
+    with open(source_path, 'rb') as source, open(target_path, 'ab') as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+# Append audio files to an existing merged MP3 in place. Only the new inputs
+# are read (and encoded to the base file's rate/channels if needed), so each
+# round costs as much as the new audio and adds no extra lossy generation.
+# With a `sink` the combined MP3 (base bytes, then the new frames) is also
+# streamed to the sink while the new frames are appended.
+async def append_audios(base_path, input_paths, cache_keys=None, sink=None):
+    base = await probe_audio(base_path)
+    list_dir = os.path.dirname(os.path.abspath(base_path))
+    if sink is not None:
+        with open(base_path, 'rb') as base_file:
+            while True:
+                chunk = await asyncio.to_thread(base_file.read, STREAM_CHUNK)
+                if not chunk:
+                    break
+                await sink(chunk)
+        with open(base_path, 'ab') as base_file:
+            async def append(chunk):
+                await asyncio.to_thread(base_file.write, chunk)
+                await sink(chunk)
+            await concat_audios(
+                input_paths, os.path.join(list_dir, 'segment.mp3'),
+                base['sample_rate'], base['channels'], cache_keys, sink=append
+            )
+        return base_path
+
+    fd, segment_path = tempfile.mkstemp(suffix='.mp3', dir=list_dir)
+    os.close(fd)
+    try:
+        await concat_audios(input_paths, segment_path, base['sample_rate'], base['channels'], cache_keys)
+        with stage_timer('encode'):
+            await media_executor.run_blocking(_append_file, segment_path, base_path)
+    finally:
+        if os.path.exists(segment_path):
+            os.remove(segment_path)
+
+    return base_path
+
+# Still-image video settings: a very low frame rate, a keyframe every
+# VIDEO_GOP frames and the picture bounded to VIDEO_MAX_SIZE on each side
+VIDEO_FPS = os.getenv('VIDEO_FPS', '1')
+VIDEO_GOP = int(os.getenv('VIDEO_GOP', 10))
+VIDEO_MAX_SIZE = int(os.getenv('VIDEO_MAX_SIZE', 1280))
+VIDEO_PRESET = os.getenv('VIDEO_PRESET', 'veryfast')
+
+# Videos longer than two segments are built from segments of about
+# VIDEO_SEGMENT_SECONDS (whole GOPs; 0 renders in one pass). The picture
+# never changes, so segments of equal length are identical: only the
+# distinct lengths (a full segment and the remainder) are encoded, in
+# parallel, and the concat demuxer repeats them with stream copy before
+# the audio is muxed in once.
+VIDEO_SEGMENT_SECONDS = int(os.getenv('VIDEO_SEGMENT_SECONDS', 300))
+
+# ffmpeg command downscaling the image once (never upscaling) to even dimensions
+def build_scale_image_command(image_path, output_path):
+    size = VIDEO_MAX_SIZE
+    scale = (
+        f"scale='min({size},iw)':'min({size},ih)':force_original_aspect_ratio=decrease,"
+        "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+    )
+    return [
+        'ffmpeg', '-v', 'error',
+        '-i', image_path,
+        '-vf', scale, '-frames:v', '1', '-q:v', '2',
+        '-y', output_path
+    ]
+
+VIDEO_ENCODE_ARGS = [
+    '-c:v', 'libx264', '-preset', VIDEO_PRESET, '-tune', 'stillimage',
+    '-r', VIDEO_FPS, '-g', str(VIDEO_GOP), '-pix_fmt', 'yuv420p'
+]
+
+def _video_audio_args(audio_codec):
+    if audio_codec == 'aac':
+        return ['-c:a', 'copy']
+    return ['-c:a', 'aac', '-b:a', '192k']
+
+# Ends a video with its audio when the audio has no probed duration (some
+# raw streams and damaged headers); the interleave settings keep the muxer
+# from running on past the audio by its buffered video frames
+SHORTEST_ARGS = ['-shortest', '-fflags', '+shortest', '-max_interleave_delta', '100M']
+
+# Output arguments of a finished video; a streamed result (output_path
+# None) is written as fragmented MP4
+def _video_output_args(output_path, duration):
+    length = ['-t', f'{duration:.3f}'] if duration else SHORTEST_ARGS
+    return length + [
+        '-movflags', '+faststart' if output_path else 'frag_keyframe+empty_moov+default_base_moof'
+    ] + _output_args(output_path, 'mp4')
+
+# ffmpeg command looping a prepared still image over the audio track
+def build_still_video_command(image_path, audio_path, output_path, duration, audio_codec):
+    return [
+        'ffmpeg', '-v', 'error',
+        '-loop', '1', '-framerate', VIDEO_FPS, '-i', image_path,
+        '-i', audio_path,
+        '-map', '0:v:0', '-map', '1:a:0'
+    ] + VIDEO_ENCODE_ARGS + _video_audio_args(audio_codec) + _video_output_args(output_path, duration)
+
+# ffmpeg command encoding `frames` frames of the still image, video only
+def build_still_segment_command(image_path, output_path, frames):
+    return [
+        'ffmpeg', '-v', 'error',
+        '-loop', '1', '-framerate', VIDEO_FPS, '-i', image_path,
+        '-map', '0:v:0'
+    ] + VIDEO_ENCODE_ARGS + ['-frames:v', str(frames), '-an', '-y', output_path]
+
+# ffmpeg command joining video segments with stream copy and muxing in the audio
+def build_segment_mux_command(list_path, audio_path, output_path, duration, audio_codec):
+    return [
+        'ffmpeg', '-v', 'error',
+        '-f', 'concat', '-safe', '0', '-i', list_path,
+        '-i', audio_path,
+        '-map', '0:v:0', '-map', '1:a:0',
+        '-c:v', 'copy'
+    ] + _video_audio_args(audio_codec) + _video_output_args(output_path, duration)
+
+# Frames per full segment, number of full segments and frames left over,
+# or None when the video is too short to be worth segmenting or its length
+# is unknown
+def _segment_plan(duration):
+    if VIDEO_SEGMENT_SECONDS <= 0 or not duration:
+        return None
+    fps = Fraction(VIDEO_FPS)
+    total = round(Fraction(duration).limit_denominator(1000) * fps)
+    gops = max(1, round(VIDEO_SEGMENT_SECONDS * fps / VIDEO_GOP))
+    segment = gops * VIDEO_GOP
+    if total < 2 * segment:
+        return None
+    return segment, int(total // segment), int(total % segment)
+
+# Encode the distinct segments in parallel, then concat and mux the audio
+async def _render_segmented(image_path, audio_path, output_path, audio_info, plan, work_dir, sink):
+    segment_frames, count, remainder = plan
+    lengths = [segment_frames] + ([remainder] if remainder else [])
+    paths = {}
+    list_path = None
+    try:
+        for frames in lengths:
+            fd, paths[frames] = tempfile.mkstemp(suffix='.mp4', dir=work_dir)
+            os.close(fd)
+        await asyncio.gather(*(
+            media_executor.run_process(build_still_segment_command(image_path, paths[frames], frames))
+            for frames in lengths
+        ))
+        fd, list_path = tempfile.mkstemp(suffix='.txt', dir=work_dir)
+        with os.fdopen(fd, 'w') as list_file:
+            list_file.write(_concat_entry(paths[segment_frames]) * count)
+            if remainder:
+                list_file.write(_concat_entry(paths[remainder]))
+        logger.info(f"Rendering video as {count} x {segment_frames} + {remainder} frames")
+        await _run_output(build_segment_mux_command(
+            list_path, audio_path, None if sink else output_path, audio_info['duration'], audio_info['codec']
+        ), sink)
+    finally:
+        for path in list(paths.values()) + [list_path]:
+            if path and os.path.exists(path):
+                os.remove(path)
+
+# Render a video from one image and an audio file, to output_path or
+# streamed to `sink`
+async def render_still_video(image_path, audio_path, output_path, sink=None):
+    audio_info = await probe_audio(audio_path)
+    work_dir = os.path.dirname(os.path.abspath(output_path))
+    fd, scaled_path = tempfile.mkstemp(suffix='.jpg', dir=work_dir)
+    os.close(fd)
+    try:
+        with stage_timer('encode'):
+            await media_executor.run_process(build_scale_image_command(image_path, scaled_path))
+            plan = _segment_plan(audio_info['duration'])
+            if plan:
+                await _render_segmented(scaled_path, audio_path, output_path, audio_info, plan, work_dir, sink)
+            else:
+                await _run_output(build_still_video_command(
+                    scaled_path, audio_path, None if sink else output_path, audio_info['duration'], audio_info['codec']
+                ), sink)
+    finally:
+        if os.path.exists(scaled_path):
+            os.remove(scaled_path)
+
+    return output_path
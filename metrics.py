@@ -0,0 +1,113 @@
+import time
+import contextvars
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Job type ('merge', 'add_more', 'video') of the task doing the work; media
+# code reads it to label its stage timings
+current_job = contextvars.ContextVar('current_job', default='other')
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+# Cumulative histogram with a fixed label set, rendered in the Prometheus
+# text format
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., sum, count]
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    # Observe the time spent in the `with` block
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series):
+                labels = _format_labels(self.labelnames, key, [('le', bound)])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+# Gauge (or counter) whose value is read from a callback at scrape time
+class Gauge:
+    def __init__(self, name, documentation, read, kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+        self.kind = kind
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+            f"{self.name} {self.read()}"
+        ]
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# Per-stage time of jobs: 'download' (waiting for inputs), 'decode' (probing
+# and decoding inputs), 'encode' (writing the output: re-encode, remux or
+# append) and 'upload'. Stages of the streaming merge overlap.
+STAGE_SECONDS = registry.register(Histogram(
+    'avbot_job_stage_seconds', 'Time spent in each stage of a job', ['job', 'stage']
+))
+
+# From pressing the button (queue wait included) until the job finished
+JOB_SECONDS = registry.register(Histogram(
+    'avbot_job_seconds', 'End-to-end job latency', ['job']
+))
+
+# Transfer time of single input files (cache hits excluded)
+DOWNLOAD_SECONDS = registry.register(Histogram(
+    'avbot_file_download_seconds', 'Time to download one input file'
+))
+
+# Time a stage of the current job
+def stage_timer(stage):
+    return STAGE_SECONDS.time(job=current_job.get(), stage=stage)
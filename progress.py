@@ -0,0 +1,91 @@
+import os
+import time
+import asyncio
+import logging
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Minimum seconds between two edits of messages in the same chat
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', 2))
+
+# Coalesces status message edits. update() only records the latest text and
+# never waits on the network; a background task sends at most one edit per
+# PROGRESS_INTERVAL per chat and skips edits whose text has not changed.
+class ProgressReporter:
+    # chat_id -> earliest monotonic time the next edit may be sent,
+    # shared by every reporter so the limit holds per chat
+    _next_edit = {}
+
+    def __init__(self, bot, chat_id, message_id, interval=PROGRESS_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval
+        self._pending = None
+        self._sent_text = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    # Record new text for the status message (sent later, coalesced)
+    def update(self, text, **kwargs):
+        self._pending = (text, kwargs)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            delay = self._next_edit.get(self.chat_id, 0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._send()
+
+    async def _send(self):
+        if self._pending is None:
+            return
+        text, kwargs = self._pending
+        self._pending = None
+        if text == self._sent_text:
+            return
+
+        self._reserve_slot(self.interval)
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                text=text,
+                **kwargs
+            )
+            self._sent_text = text
+        except RetryAfter as e:
+            # Flood control: back off and retry unless newer text arrived
+            self._reserve_slot(e.retry_after)
+            if self._pending is None:
+                self._pending = (text, kwargs)
+            self._wakeup.set()
+        except Exception as e:
+            logger.warning(f"Error updating progress message: {e}")
+
+    def _reserve_slot(self, delay):
+        now = time.monotonic()
+        if len(self._next_edit) > 1024:
+            for chat_id, until in list(self._next_edit.items()):
+                if until < now:
+                    del self._next_edit[chat_id]
+        self._next_edit[self.chat_id] = now + delay
+
+    # Stop the background task; with flush=True the latest text is sent first
+    async def close(self, flush=False):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if flush:
+            await self._send()
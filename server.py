@@ -1,31 +1,192 @@
 import os
-import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import hmac
+import argparse
+import json
+import signal
+import asyncio
+import logging
+
+from telegram import Update
 
 # Import bot
-from bot import main as run_bot
-
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'Bot is running!')
-    
-    def log_message(self, format, *args):
-        pass  # Disable logging
-
-def run_server():
-    port = int(os.getenv('PORT', 10000))
-    server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
-    print(f"Health check server running on port {port}")
-    server.serve_forever()
+from bot import TOKEN, build_application, restore_sessions, user_data
+from jobs import job_scheduler
+from cache import input_cache
+from workspace import workspaces
+from metrics import registry, Gauge
+from worker import run_worker
+
+logger = logging.getLogger(__name__)
+
+PORT = int(os.getenv('PORT', 10000))
+
+# Public HTTPS base URL Telegram posts updates to; long polling is used when unset
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+
+# Largest request body accepted (updates are a few KB)
+MAX_BODY = 1024 * 1024
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large'}
+
+# Gauges read at scrape time, next to the job timings recorded in metrics.py
+registry.register(Gauge('avbot_active_jobs', 'Jobs running now', lambda: job_scheduler.active_count))
+registry.register(Gauge('avbot_queued_jobs', 'Jobs waiting for a slot', lambda: job_scheduler.queue_depth))
+registry.register(Gauge('avbot_sessions', 'Sessions held in user_data', lambda: len(user_data)))
+registry.register(Gauge('avbot_scratch_bytes', 'Bytes used by scratch workspaces', lambda: workspaces.usage()))
+registry.register(Gauge('avbot_input_cache_bytes', 'Bytes held by the input cache', lambda: input_cache.stats()['bytes']))
+registry.register(Gauge('avbot_input_cache_hits_total', 'Inputs served from the cache', lambda: input_cache.hits, 'counter'))
+registry.register(Gauge('avbot_input_cache_misses_total', 'Inputs that had to be downloaded', lambda: input_cache.misses, 'counter'))
+registry.register(Gauge('avbot_input_cache_saved_bytes_total', 'Download bytes saved by the input cache', lambda: input_cache.bytes_saved, 'counter'))
+
+# One asyncio HTTP/1.1 server for Telegram webhook updates, the health
+# check and metrics. Updates are only parsed and queued here; the
+# application handles them with its configured concurrency.
+class BotServer:
+    def __init__(self, application, port=PORT, webhook_path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        self.application = application
+        self.port = port
+        self.webhook_path = webhook_path
+        self.secret = secret
+        self._server = None
+        self._writers = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, '0.0.0.0', self.port)
+        logger.info(f"HTTP server running on port {self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Drop idle keep-alive connections so wait_closed() returns
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                status, content_type, payload = await self._route(method, path.split('?')[0], headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, payload, content_type, close=not keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error(f"Error handling HTTP request: {e}")
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _route(self, method, path, headers, body):
+        if path == self.webhook_path:
+            if method != 'POST':
+                return 405, 'text/plain', b''
+            return await self._handle_update(headers, body)
+        if method != 'GET':
+            return 405, 'text/plain', b''
+        if path in ('/', '/healthz'):
+            return 200, 'text/plain', b'Bot is running!'
+        if path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', registry.render().encode()
+        return 404, 'text/plain', b''
+
+    async def _handle_update(self, headers, body):
+        token = headers.get('x-telegram-bot-api-secret-token', '')
+        if self.secret and not hmac.compare_digest(token, self.secret):
+            return 403, 'text/plain', b''
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.warning(f"Invalid webhook update: {e}")
+            return 400, 'text/plain', b''
+        await self.application.update_queue.put(update)
+        return 200, 'text/plain', b''
+
+    async def _respond(self, writer, status, payload=b'', content_type='text/plain', close=False):
+        head = (
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + payload)
+        await writer.drain()
+
+# Run the bot and the HTTP server on one event loop until SIGINT/SIGTERM.
+# With WEBHOOK_URL set Telegram pushes updates to the server, otherwise
+# the bot long-polls and the server only answers health checks and metrics.
+async def serve():
+    application = build_application()
+    server = BotServer(application)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await application.start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+            logger.info(f"Receiving updates by webhook at {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            logger.info("Receiving updates by long polling")
+        await server.start()
+        await stop.wait()
+    finally:
+        await server.stop()
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
 if __name__ == '__main__':
-    # Start web server in background thread
-    server_thread = threading.Thread(target=run_server, daemon=True)
-    server_thread.start()
-    
-    # Run bot in main thread
-    print("Starting Telegram bot...")
-    run_bot()
+    parser = argparse.ArgumentParser()
+    # 'worker' only renders jobs from RENDER_QUEUE and never talks to Telegram
+    parser.add_argument('--role', choices=['bot', 'worker'], default='bot')
+    args = parser.parse_args()
+    if args.role == 'worker':
+        print("Starting render worker...")
+        asyncio.run(run_worker())
+    elif not TOKEN:
+        logger.error("BOT_TOKEN not found in environment variables!")
+    else:
+        restore_sessions()
+        print("Starting Telegram bot...")
+        asyncio.run(serve())
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+logger = logging.getLogger(__name__)
+
+# Idle sessions expire after SESSION_TTL_MINUTES; beyond SESSION_MAX the
+# least recently used session is evicted
+SESSION_TTL = int(os.getenv('SESSION_TTL_MINUTES', 360)) * 60
+SESSION_MAX = int(os.getenv('SESSION_MAX', 10000))
+
+# Keeps sessions only in process memory (nothing survives a restart)
+class MemoryBackend:
+    persistent = False
+
+    def load_all(self):
+        return []
+
+    def write(self, rows, deleted):
+        pass
+
+    def close(self):
+        pass
+
+# Stores each session as a JSON row in a SQLite database
+class SQLiteBackend:
+    persistent = True
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            'user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)'
+        )
+        self._conn.commit()
+
+    # All stored sessions as (user_id, session, updated) tuples, oldest first
+    def load_all(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT user_id, data, updated FROM sessions ORDER BY updated').fetchall()
+        return [(user_id, json.loads(data), updated) for user_id, data, updated in rows]
+
+    # Upsert `rows` of (user_id, json, updated) and delete `deleted` user IDs in one transaction
+    def write(self, rows, deleted):
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)', rows)
+            self._conn.executemany('DELETE FROM sessions WHERE user_id = ?', [(user_id,) for user_id in deleted])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# Backend chosen by SESSION_BACKEND ('memory' or 'sqlite', stored in SESSION_DB)
+def create_backend():
+    if os.getenv('SESSION_BACKEND', 'memory') == 'sqlite':
+        return SQLiteBackend(os.getenv('SESSION_DB', 'sessions.db'))
+    return MemoryBackend()
+
+# Dict-like per-user session storage with idle TTL and LRU eviction.
+# `on_evict(user_id, session)` runs for every expired or evicted session;
+# sessions for which `is_pinned(user_id)` is true are never evicted.
+# With a persistent backend every live session stays cached in memory and
+# changes are written back in batches by flush().
+class SessionStore(MutableMapping):
+    def __init__(self, max_size=SESSION_MAX, ttl=SESSION_TTL, on_evict=None, is_pinned=None, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.is_pinned = is_pinned
+        self.backend = backend or MemoryBackend()
+        self._sessions = OrderedDict()
+        self._last_seen = {}
+        self._dirty = set()
+        self._deleted = set()
+
+    def _touch(self, user_id):
+        self._sessions.move_to_end(user_id)
+        self._last_seen[user_id] = time.monotonic()
+        # Handlers mutate sessions in place, so any access may change one
+        if self.backend.persistent:
+            self._dirty.add(user_id)
+            self._deleted.discard(user_id)
+
+    def _forget(self, user_id):
+        del self._last_seen[user_id]
+        if self.backend.persistent:
+            self._dirty.discard(user_id)
+            self._deleted.add(user_id)
+
+    def __getitem__(self, user_id):
+        session = self._sessions[user_id]
+        self._touch(user_id)
+        return session
+
+    def __setitem__(self, user_id, session):
+        self._sessions[user_id] = session
+        self._touch(user_id)
+        self._evict_overflow()
+
+    def __delitem__(self, user_id):
+        del self._sessions[user_id]
+        self._forget(user_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def __iter__(self):
+        return iter(list(self._sessions))
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _pinned(self, user_id):
+        return self.is_pinned is not None and self.is_pinned(user_id)
+
+    def _evict(self, user_id):
+        session = self._sessions.pop(user_id)
+        self._forget(user_id)
+        if self.on_evict is not None:
+            try:
+                self.on_evict(user_id, session)
+            except Exception as e:
+                logger.error(f"Error evicting session {user_id}: {e}")
+
+    def _evict_overflow(self):
+        for user_id in list(self._sessions):
+            if len(self._sessions) <= self.max_size:
+                break
+            if not self._pinned(user_id):
+                self._evict(user_id)
+
+    # Evict sessions idle for longer than the TTL; returns how many went
+    def expire(self):
+        deadline = time.monotonic() - self.ttl
+        expired = 0
+        # Sessions are kept in least-recently-used order
+        for user_id in list(self._sessions):
+            if self._last_seen[user_id] > deadline:
+                break
+            if not self._pinned(user_id):
+                self._evict(user_id)
+                expired += 1
+        if expired:
+            logger.info(f"Expired {expired} idle sessions")
+        return expired
+
+    # Load stored sessions into memory (idle time is kept across restarts);
+    # returns the loaded sessions
+    def load(self):
+        now = time.time()
+        for user_id, session, updated in self.backend.load_all():
+            self._sessions[user_id] = session
+            self._last_seen[user_id] = time.monotonic() - max(0, now - updated)
+        self._evict_overflow()
+        logger.info(f"Loaded {len(self._sessions)} sessions")
+        return dict(self._sessions)
+
+    # Write changed and deleted sessions to the backend in one batch
+    async def flush(self):
+        if not self._dirty and not self._deleted:
+            return
+        now = time.time()
+        rows = []
+        for user_id in self._dirty:
+            try:
+                rows.append((user_id, json.dumps(self._sessions[user_id]), now))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error(f"Error serializing session {user_id}: {e}")
+        deleted = list(self._deleted)
+        self._dirty.clear()
+        self._deleted.clear()
+        await asyncio.to_thread(self.backend.write, rows, deleted)
@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep the module-level scratch root and input cache out of the ones a
+# running bot uses
+os.environ.setdefault('SCRATCH_DIR', tempfile.mkdtemp(prefix='avbot-test-scratch-'))
+os.environ.setdefault('INPUT_CACHE_DIR', tempfile.mkdtemp(prefix='avbot-test-cache-'))
+
+from fake_bot_api import FakeBotAPI
+
+@pytest.fixture
+def bot_api():
+    api = FakeBotAPI().start()
+    yield api
+    api.stop()
@@ -0,0 +1,123 @@
+import json
+import time
+import itertools
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Test Bot', 'username': 'test_bot'}
+
+# Minimal stand-in for a telegram-bot-api server started with --local:
+# getFile answers with absolute paths of files registered with add_file(),
+# send* methods answer with a Message and every call is recorded in `calls`
+# as (method, fields, files) with uploaded files as bytes.
+class FakeBotAPI:
+    def __init__(self, token='123:TEST'):
+        self.token = token
+        self.calls = []
+        self._files = {}
+        self._message_ids = itertools.count(1)
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/bot"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # Serve `path` (a local file) as the file with id `file_id`
+    def add_file(self, file_id, path, size=None):
+        self._files[file_id] = (path, size)
+
+    # Recorded calls of one Bot API method
+    def calls_of(self, method):
+        return [call for call in self.calls if call[0] == method]
+
+    def _answer(self, method, fields):
+        if method == 'getMe':
+            return True, BOT_USER
+        if method == 'getFile':
+            if fields.get('file_id') not in self._files:
+                return False, 'Bad Request: invalid file_id'
+            path, size = self._files[fields['file_id']]
+            return True, {
+                'file_id': fields['file_id'],
+                'file_unique_id': f"u{fields['file_id']}",
+                'file_size': size,
+                'file_path': path
+            }
+        if method.startswith('send'):
+            return True, {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(fields.get('chat_id', 0)), 'type': 'private'},
+                'from': BOT_USER,
+                'text': fields.get('text')
+            }
+        return True, True
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _body(self):
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    body = b''
+                    while True:
+                        size = int(self.rfile.readline().split(b';')[0], 16)
+                        chunk = self.rfile.read(size + 2)
+                        if not size:
+                            return body
+                        body += chunk[:-2]
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def _parse(self, body):
+                content_type = self.headers.get('Content-Type', '')
+                fields, files = {}, {}
+                if content_type.startswith('multipart/form-data'):
+                    message = BytesParser(policy=HTTP).parsebytes(
+                        f'Content-Type: {content_type}\r\n\r\n'.encode() + body
+                    )
+                    for part in message.iter_parts():
+                        name = part.get_param('name', header='content-disposition')
+                        if part.get_filename() is not None:
+                            files[name] = part.get_payload(decode=True)
+                        else:
+                            fields[name] = part.get_payload(decode=True).decode()
+                elif content_type.startswith('application/json'):
+                    fields = json.loads(body or b'{}')
+                else:
+                    fields = dict(parse_qsl(body.decode()))
+                return fields, files
+
+            def do_POST(self):
+                prefix, _, method = self.path.rpartition('/')
+                if prefix != f"/bot{api.token}":
+                    self.send_error(404)
+                    return
+                fields, files = self._parse(self._body())
+                api.calls.append((method, fields, files))
+                ok, result = api._answer(method, fields)
+                reply = {'ok': True, 'result': result} if ok else {'ok': False, 'error_code': 400, 'description': result}
+                data = json.dumps(reply).encode()
+                self.send_response(200 if ok else 400)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,62 @@
+import asyncio
+
+from telegram import Audio, Bot
+
+import bot
+from downloads import downloads
+
+class FakeApplication:
+    def __init__(self):
+        self.tasks = []
+
+    def create_task(self, coroutine, update=None):
+        task = asyncio.create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+class FakeContext:
+    def __init__(self, telegram_bot):
+        self.bot = telegram_bot
+        self.application = FakeApplication()
+
+def test_failed_download_is_dropped_from_the_session(bot_api, tmp_path):
+    source = tmp_path / 'served.mp3'
+    source.write_bytes(b'ID3 audio')
+    bot_api.add_file('f1', str(source), size=9)
+    user_id = 42
+    bot.user_data[user_id] = {'audio_files': [], 'audio_names': [], 'audio_ids': [], 'user_messages': []}
+
+    async def main():
+        async with Bot(bot_api.token, base_url=bot_api.base_url, local_mode=True) as telegram_bot:
+            context = FakeContext(telegram_bot)
+            session = bot.user_data[user_id]
+            for file_id, name in (('f1', 'first.mp3'), ('gone', 'second.mp3'), ('f1', 'third.mp3')):
+                attachment = Audio.de_json({'file_id': file_id, 'file_unique_id': f"u-{name}", 'duration': 1}, telegram_bot)
+                path = str(tmp_path / f"audio_{bot.next_file_number(user_id, 'audio_files')}.mp3")
+                bot.start_download(context, user_id, attachment, path)
+                session['audio_files'].append(path)
+                session['audio_names'].append(name)
+                session['audio_ids'].append(f"u-{name}")
+            try:
+                await downloads.wait(list(session['audio_files']))
+            except Exception:
+                pass
+            await asyncio.gather(*context.application.tasks)
+
+            # The next file does not reuse the name of a file still listed
+            assert bot.next_file_number(user_id, 'audio_files') == 3
+            # A later "done" only waits for files that arrived
+            await downloads.wait(session['audio_files'])
+
+    try:
+        asyncio.run(main())
+        session = bot.user_data[user_id]
+        assert session['audio_names'] == ['first.mp3', 'third.mp3']
+        assert session['audio_ids'] == ['u-first.mp3', 'u-third.mp3']
+        assert session['audio_files'] == [str(tmp_path / 'audio_0.mp3'), str(tmp_path / 'audio_2.mp3')]
+        method, fields, _ = bot_api.calls_of('sendMessage')[0]
+        assert fields['chat_id'] == '42'
+        assert 'second.mp3' in fields['text']
+        assert session['user_messages'] == [1]
+    finally:
+        del bot.user_data[user_id]
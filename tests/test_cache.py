@@ -0,0 +1,75 @@
+import os
+
+from cache import InputCache, ResultCache, job_key
+
+def write(path, nbytes):
+    with open(path, 'wb') as file:
+        file.write(b'x' * nbytes)
+
+def test_input_cache_hits_misses_and_stats(tmp_path):
+    cache = InputCache(root=str(tmp_path / 'cache'), max_bytes=1000)
+    source = tmp_path / 'upload.mp3'
+    write(source, 300)
+
+    assert not cache.fetch('u1', str(tmp_path / 'miss.mp3'))
+    cache.store('u1', str(source))
+    assert cache.fetch('u1', str(tmp_path / 'hit.mp3'))
+    assert (tmp_path / 'hit.mp3').read_bytes() == source.read_bytes()
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'bytes_saved': 300, 'entries': 1, 'bytes': 300}
+
+def test_input_cache_evicts_least_recently_used(tmp_path):
+    cache = InputCache(root=str(tmp_path / 'cache'), max_bytes=1000)
+    source = tmp_path / 'upload.mp3'
+    write(source, 400)
+    cache.store('u1', str(source))
+    cache.store('u2', str(source))
+    cache.fetch('u1', str(tmp_path / 'used.mp3'))
+    cache.store('u3', str(source))
+
+    assert cache.stats()['bytes'] == 800
+    assert not os.path.exists(tmp_path / 'cache' / 'u2')
+    assert cache.fetch('u1', str(tmp_path / 'a.mp3'))
+    assert not cache.fetch('u2', str(tmp_path / 'b.mp3'))
+
+    # Files over the whole budget are not cached
+    write(source, 2000)
+    cache.store('big', str(source))
+    assert not cache.fetch('big', str(tmp_path / 'c.mp3'))
+
+def test_input_cache_survives_a_restart(tmp_path):
+    root = tmp_path / 'cache'
+    cache = InputCache(root=str(root), max_bytes=1000)
+    write(tmp_path / 'upload.mp3', 100)
+    cache.store('u1', str(tmp_path / 'upload.mp3'))
+    # A store cut off by the restart
+    write(root / 'u2.part', 50)
+
+    reopened = InputCache(root=str(root), max_bytes=1000)
+    assert reopened.stats()['entries'] == 1
+    assert not os.path.exists(root / 'u2.part')
+    assert reopened.fetch('u1', str(tmp_path / 'a.mp3'))
+
+def test_job_key_depends_on_every_part():
+    assert job_key('merge', 'a', 'b') == job_key('merge', 'a', 'b')
+    assert job_key('merge', 'a', 'b') != job_key('merge', 'b', 'a')
+    assert job_key('merge', 'ab') != job_key('merge', 'a', 'b')
+
+def test_result_cache_is_bounded_and_persisted(tmp_path):
+    path = str(tmp_path / 'results.db')
+    cache = ResultCache(path, max_size=2)
+    cache.put('k1', 'file1', 100)
+    cache.put('k2', 'file2', 200)
+    assert cache.get('k1') == ('file1', 100)
+    cache.put('k3', 'file3', 300)
+    assert cache.get('k2') is None
+    cache.discard('k3')
+
+    reopened = ResultCache(path, max_size=2)
+    assert reopened.get('k1') == ('file1', 100)
+    assert reopened.get('k3') is None
+
+def test_result_cache_in_memory_only():
+    cache = ResultCache(None, max_size=10)
+    cache.put('k1', 'file1', 100)
+    assert cache.get('k1') == ('file1', 100)
+    assert ResultCache(None).get('k1') is None
@@ -0,0 +1,56 @@
+import asyncio
+
+from telegram.error import BadRequest, RetryAfter
+
+from cleanup import MessageCleaner
+
+class FakeBot:
+    def __init__(self, failures=()):
+        self.calls = []
+        self.failures = list(failures)
+
+    async def delete_messages(self, chat_id, message_ids):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.calls.append((chat_id, list(message_ids)))
+
+def test_deletions_are_batched_per_chat():
+    async def main():
+        bot = FakeBot()
+        cleaner = MessageCleaner(rate=1000)
+        cleaner.schedule(1, range(1, 251))
+        cleaner.schedule(2, [5, None, 6])
+        # Duplicates are only deleted once
+        cleaner.schedule(2, [6, 7])
+        cleaner.start(bot)
+        await asyncio.sleep(0.1)
+        await cleaner.close()
+        return bot.calls
+    calls = asyncio.run(main())
+    assert [len(ids) for chat_id, ids in calls if chat_id == 1] == [100, 100, 50]
+    assert sorted(sum((ids for chat_id, ids in calls if chat_id == 1), [])) == list(range(1, 251))
+    assert [ids for chat_id, ids in calls if chat_id == 2] == [[5, 6, 7]]
+
+def test_flood_control_and_errors():
+    async def main():
+        bot = FakeBot(failures=[RetryAfter(0.05), BadRequest('Message to delete not found')])
+        cleaner = MessageCleaner(rate=1000)
+        cleaner.start(bot)
+        cleaner.schedule(1, [1, 2])
+        cleaner.schedule(2, [3])
+        await asyncio.sleep(0.2)
+        await cleaner.close()
+        return bot.calls
+    # The batch hit by flood control is sent again; the failed one is dropped
+    assert asyncio.run(main()) == [(1, [1, 2])]
+
+def test_close_flushes_queued_deletions():
+    async def main():
+        bot = FakeBot()
+        cleaner = MessageCleaner(rate=1000)
+        cleaner.start(bot)
+        await asyncio.sleep(0)
+        cleaner.schedule(1, [1])
+        await cleaner.close()
+        return bot.calls
+    assert asyncio.run(main()) == [(1, [1])]
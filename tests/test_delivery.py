@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+from telegram import Bot
+
+import delivery
+
+def test_send_stream_uploads_while_producing(bot_api, tmp_path):
+    saved = tmp_path / 'merged.mp3'
+
+    async def produce(sink):
+        for index in range(5):
+            await sink(bytes([index]) * 1000)
+
+    async def main():
+        bot = Bot(bot_api.token, base_url=bot_api.base_url)
+        try:
+            return await delivery.send_stream(
+                bot, 'sendAudio', 'audio', 'merged.mp3', delivery.tee(produce, str(saved)),
+                chat_id=42, title='merged'
+            )
+        finally:
+            await delivery.close()
+    message = asyncio.run(main())
+
+    assert message.chat.id == 42
+    _, fields, files = bot_api.calls_of('sendAudio')[0]
+    assert fields == {'chat_id': '42', 'title': 'merged'}
+    assert files['audio'] == b''.join(bytes([index]) * 1000 for index in range(5))
+    assert saved.read_bytes() == files['audio']
+
+def test_send_stream_enforces_the_upload_limit(bot_api):
+    async def produce(sink):
+        for _ in range(10):
+            await sink(b'x' * 100)
+
+    async def main():
+        bot = Bot(bot_api.token, base_url=bot_api.base_url)
+        try:
+            await delivery.send_stream(bot, 'sendAudio', 'audio', 'merged.mp3', produce, max_bytes=500, chat_id=42)
+        finally:
+            await delivery.close()
+    with pytest.raises(delivery.UploadTooLargeError):
+        asyncio.run(main())
+    assert not bot_api.calls_of('sendAudio')
@@ -0,0 +1,70 @@
+import os
+import asyncio
+
+import pytest
+from telegram import Audio, Bot
+from telegram.error import BadRequest
+
+from downloads import DownloadManager, fetch_file
+from workspace import workspaces
+
+def run_with_bot(bot_api, func):
+    async def main():
+        async with Bot(bot_api.token, base_url=bot_api.base_url, local_mode=True) as bot:
+            return await func(bot)
+    return asyncio.run(main())
+
+def test_fetch_file_links_local_files(bot_api, tmp_path):
+    source = tmp_path / 'served.mp3'
+    source.write_bytes(b'ID3 audio')
+    bot_api.add_file('f1', str(source), size=9)
+
+    async def fetch(bot):
+        telegram_file = await bot.get_file('f1')
+        await fetch_file(telegram_file, str(tmp_path / 'linked.mp3'))
+        await fetch_file(telegram_file, str(tmp_path / 'copied.mp3'), copy=True)
+    run_with_bot(bot_api, fetch)
+
+    assert bot_api.calls_of('getFile')[0][1]['file_id'] == 'f1'
+    assert (tmp_path / 'linked.mp3').read_bytes() == b'ID3 audio'
+    assert os.path.samefile(source, tmp_path / 'linked.mp3')
+    # Copies may be modified in place without touching the server's file
+    assert (tmp_path / 'copied.mp3').read_bytes() == b'ID3 audio'
+    assert not os.path.samefile(source, tmp_path / 'copied.mp3')
+
+def test_send_audio_passes_local_path(bot_api, tmp_path):
+    audio = tmp_path / 'merged.mp3'
+    audio.write_bytes(b'ID3 merged')
+
+    # As open_upload() passes results to a local server
+    async def send(bot):
+        return await bot.send_audio(chat_id=42, audio=audio, title='merged')
+    message = run_with_bot(bot_api, send)
+
+    assert message.chat.id == 42
+    method, fields, _ = bot_api.calls_of('sendAudio')[0]
+    assert fields['audio'] == audio.as_uri()
+    assert fields['title'] == 'merged'
+
+def test_downloads_run_in_the_background(bot_api, tmp_path):
+    source = tmp_path / 'served.mp3'
+    source.write_bytes(b'ID3 audio')
+    bot_api.add_file('f1', str(source), size=9)
+
+    async def download(bot):
+        manager = DownloadManager(cache=None)
+        good = Audio.de_json({'file_id': 'f1', 'file_unique_id': 'u1', 'duration': 1, 'file_size': 9}, bot)
+        bad = Audio.de_json({'file_id': 'gone', 'file_unique_id': 'u2', 'duration': 1, 'file_size': 5}, bot)
+        manager.start(1, good, str(tmp_path / 'a.mp3'))
+        manager.start(1, bad, str(tmp_path / 'b.mp3'))
+        # Started downloads count against the user's quota until they end
+        assert workspaces.held(1) == 14
+        await manager.wait([str(tmp_path / 'a.mp3')])
+        with pytest.raises(BadRequest):
+            await manager.wait([str(tmp_path / 'b.mp3')])
+        assert workspaces.held(1) == 0
+    run_with_bot(bot_api, download)
+
+    assert (tmp_path / 'a.mp3').read_bytes() == b'ID3 audio'
+    assert not os.path.exists(tmp_path / 'b.mp3')
+    assert not os.path.exists(tmp_path / 'b.mp3.part')
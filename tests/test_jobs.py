@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+from jobs import JobScheduler, QueueFullError, UserBusyError
+
+def test_jobs_over_the_cap_wait_in_order():
+    async def main():
+        scheduler = JobScheduler(max_active=1, max_queued=2)
+        release = asyncio.Event()
+        started = []
+        positions = {}
+
+        async def job(user_id):
+            started.append(user_id)
+            await release.wait()
+            return user_id
+
+        def track(user_id):
+            async def on_position(position):
+                positions.setdefault(user_id, []).append(position)
+            return on_position
+
+        tasks = [asyncio.create_task(scheduler.run(user_id, lambda user_id=user_id: job(user_id), track(user_id)))
+                 for user_id in (1, 2, 3)]
+        await asyncio.sleep(0)
+        assert started == [1]
+        assert scheduler.queue_depth == 2
+        with pytest.raises(UserBusyError):
+            await scheduler.run(2, lambda: job(2))
+        with pytest.raises(QueueFullError):
+            await scheduler.run(4, lambda: job(4))
+
+        release.set()
+        assert await asyncio.gather(*tasks) == [1, 2, 3]
+        assert started == [1, 2, 3]
+        assert positions[3] == [2, 1]
+        assert scheduler.active_count == 0
+    asyncio.run(main())
+
+def test_cancelled_waiting_job_leaves_the_queue():
+    async def main():
+        scheduler = JobScheduler(max_active=1, max_queued=5)
+        release = asyncio.Event()
+        positions = []
+
+        async def on_position(position):
+            positions.append(position)
+
+        running = asyncio.create_task(scheduler.run(1, release.wait))
+        first = asyncio.create_task(scheduler.run(2, lambda: asyncio.sleep(0)))
+        second = asyncio.create_task(scheduler.run(3, lambda: asyncio.sleep(0), on_position))
+        # Position callbacks run as tasks of their own
+        await asyncio.sleep(0.01)
+        assert positions == [2]
+
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        assert scheduler.queue_depth == 1
+        assert not scheduler.is_busy(2)
+        assert positions == [2, 1]
+        release.set()
+        await asyncio.gather(running, second)
+        assert scheduler.active_count == 0
+    asyncio.run(main())
+
+def test_cancel_during_handover_releases_the_slot():
+    async def main():
+        scheduler = JobScheduler(max_active=1, max_queued=5)
+        release = asyncio.Event()
+        running = asyncio.create_task(scheduler.run(1, release.wait))
+        waiting = asyncio.create_task(scheduler.run(2, lambda: asyncio.sleep(0)))
+        await asyncio.sleep(0)
+
+        # The slot is handed to user 2, which is cancelled before it resumes
+        release.set()
+        await asyncio.sleep(0)
+        assert running.done() and not waiting.done()
+        assert scheduler.is_busy(2) and scheduler.queue_depth == 0
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+
+        assert scheduler.active_count == 0
+        assert await scheduler.run(3, lambda: asyncio.sleep(0, 'next')) == 'next'
+    asyncio.run(main())
+
+def test_cancel_running_job_frees_its_slot():
+    async def main():
+        scheduler = JobScheduler(max_active=1, max_queued=5)
+        cleaned = asyncio.Event()
+
+        async def stuck():
+            try:
+                await asyncio.sleep(3600)
+            finally:
+                cleaned.set()
+
+        running = asyncio.create_task(scheduler.run(1, stuck))
+        waiting = asyncio.create_task(scheduler.run(2, lambda: asyncio.sleep(0, 'done')))
+        await asyncio.sleep(0)
+        assert scheduler.is_busy(2)
+
+        # cancel() returns once the job has wound down
+        assert await scheduler.cancel(1)
+        assert cleaned.is_set()
+        assert running.cancelled()
+        # The slot went to the waiting job
+        assert await waiting == 'done'
+        assert scheduler.active_count == 0
+        assert not await scheduler.cancel(1)
+    asyncio.run(main())
+
+def test_cancel_waiting_job():
+    async def main():
+        scheduler = JobScheduler(max_active=1, max_queued=5)
+        release = asyncio.Event()
+        running = asyncio.create_task(scheduler.run(1, release.wait))
+        waiting = asyncio.create_task(scheduler.run(2, lambda: asyncio.sleep(0)))
+        await asyncio.sleep(0)
+
+        assert await scheduler.cancel(2)
+        assert waiting.cancelled()
+        assert scheduler.queue_depth == 0
+        release.set()
+        await running
+        assert scheduler.active_count == 0
+    asyncio.run(main())
+
+def test_cancel_gives_up_after_the_timeout():
+    async def main():
+        scheduler = JobScheduler(max_active=1, max_queued=5)
+
+        async def stubborn():
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                await asyncio.sleep(0.2)
+                raise
+
+        running = asyncio.create_task(scheduler.run(1, stubborn))
+        await asyncio.sleep(0)
+        assert await scheduler.cancel(1, timeout=0.01)
+        assert not running.done()
+        await asyncio.gather(running, return_exceptions=True)
+        assert scheduler.active_count == 0
+    asyncio.run(main())
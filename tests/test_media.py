@@ -0,0 +1,14 @@
+from media import build_still_video_command, _segment_plan
+
+def test_video_length_follows_the_probed_duration():
+    cmd = build_still_video_command('image.jpg', 'audio.mp3', 'video.mp4', 61.5, 'mp3')
+    assert cmd[cmd.index('-t') + 1] == '61.500'
+    assert '-shortest' not in cmd
+
+def test_video_without_a_duration_ends_with_its_audio():
+    for duration in (0, 0.0, None):
+        cmd = build_still_video_command('image.jpg', 'audio.mp3', 'video.mp4', duration, 'mp3')
+        assert '-t' not in cmd
+        assert '-shortest' in cmd
+        # Unknown lengths are rendered in one pass
+        assert _segment_plan(duration) is None
@@ -0,0 +1,69 @@
+import asyncio
+
+from telegram.error import RetryAfter
+
+from progress import ProgressReporter
+
+class FakeBot:
+    def __init__(self, failures=()):
+        self.edits = []
+        self.failures = list(failures)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.edits.append(text)
+
+def test_updates_are_coalesced():
+    async def main():
+        bot = FakeBot()
+        reporter = ProgressReporter(bot, 101, 1, interval=0.05)
+        for percent in (10, 20, 30):
+            reporter.update(f"{percent}%")
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.1)
+        # Unchanged text is not sent again
+        reporter.update('30%')
+        await asyncio.sleep(0.1)
+        await reporter.close()
+        return bot.edits
+    assert asyncio.run(main()) == ['10%', '30%']
+
+def test_edits_are_rate_limited_per_chat():
+    async def main():
+        bot = FakeBot()
+        first = ProgressReporter(bot, 102, 1, interval=0.2)
+        second = ProgressReporter(bot, 102, 2, interval=0.2)
+        first.update('first')
+        await asyncio.sleep(0.01)
+        second.update('second')
+        await asyncio.sleep(0.05)
+        assert bot.edits == ['first']
+        await asyncio.sleep(0.25)
+        assert bot.edits == ['first', 'second']
+        await first.close()
+        await second.close()
+    asyncio.run(main())
+
+def test_flood_control_retries_the_latest_text():
+    async def main():
+        bot = FakeBot(failures=[RetryAfter(0.05)])
+        reporter = ProgressReporter(bot, 103, 1, interval=0.01)
+        reporter.update('50%')
+        await asyncio.sleep(0.01)
+        assert bot.edits == []
+        await asyncio.sleep(0.1)
+        assert bot.edits == ['50%']
+        await reporter.close()
+    asyncio.run(main())
+
+def test_close_can_flush_the_pending_text():
+    async def main():
+        bot = FakeBot()
+        reporter = ProgressReporter(bot, 104, 1, interval=10)
+        reporter.update('start')
+        await asyncio.sleep(0.01)
+        reporter.update('done')
+        await reporter.close(flush=True)
+        return bot.edits
+    assert asyncio.run(main()) == ['start', 'done']
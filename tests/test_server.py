@@ -0,0 +1,61 @@
+import json
+import asyncio
+
+import httpx
+from telegram import Update
+
+from server import BotServer
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = None
+        self.update_queue = asyncio.Queue()
+
+def run_with_server(func, secret='s3cret'):
+    async def main():
+        application = FakeApplication()
+        server = BotServer(application, port=0, webhook_path='/webhook', secret=secret)
+        await server.start()
+        port = server._server.sockets[0].getsockname()[1]
+        try:
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+                await func(client, application)
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+UPDATE = {'update_id': 5, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 7, 'type': 'private'}, 'text': 'hi'}}
+
+def test_routes():
+    async def check(client, application):
+        assert (await client.get('/healthz')).status_code == 200
+        assert (await client.get('/')).text == 'Bot is running!'
+        metrics = await client.get('/metrics')
+        assert metrics.status_code == 200
+        assert metrics.headers['content-type'].startswith('text/plain')
+        assert (await client.get('/missing')).status_code == 404
+        assert (await client.post('/healthz')).status_code == 405
+        assert (await client.get('/webhook')).status_code == 405
+    run_with_server(check)
+
+def test_webhook_checks_the_secret_and_queues_updates():
+    async def check(client, application):
+        headers = {'X-Telegram-Bot-Api-Secret-Token': 's3cret'}
+        denied = await client.post('/webhook', content=json.dumps(UPDATE), headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+        assert denied.status_code == 403
+        assert (await client.post('/webhook', content=b'not json', headers=headers)).status_code == 400
+        assert application.update_queue.empty()
+
+        accepted = await client.post('/webhook', content=json.dumps(UPDATE), headers=headers)
+        assert accepted.status_code == 200
+        update = application.update_queue.get_nowait()
+        assert isinstance(update, Update)
+        assert update.update_id == 5
+    run_with_server(check)
+
+def test_webhook_rejects_large_bodies():
+    async def check(client, application):
+        response = await client.post('/webhook', content=b'x' * (2 * 1024 * 1024), headers={'X-Telegram-Bot-Api-Secret-Token': 's3cret'})
+        assert response.status_code == 413
+        assert application.update_queue.empty()
+    run_with_server(check)
@@ -0,0 +1,59 @@
+import time
+import asyncio
+
+from sessions import SessionStore, SQLiteBackend
+
+def test_lru_eviction_skips_pinned_sessions():
+    evicted = []
+    store = SessionStore(max_size=2, on_evict=lambda user_id, session: evicted.append(user_id),
+                         is_pinned=lambda user_id: user_id == 1)
+    store[1] = {'mode': 'merge'}
+    store[2] = {'mode': 'merge'}
+    store[3] = {'mode': 'video'}
+    assert evicted == [2]
+    assert list(store) == [1, 3]
+
+    # Reading a session makes it the most recently used
+    store[1]
+    store[4] = {}
+    assert evicted == [2, 3]
+    assert list(store) == [1, 4]
+
+def test_idle_sessions_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    evicted = []
+    store = SessionStore(ttl=60, on_evict=lambda user_id, session: evicted.append(user_id))
+    store[1] = {}
+    now[0] += 30
+    store[2] = {}
+    now[0] += 40
+    assert store.expire() == 1
+    assert evicted == [1]
+    assert 2 in store and 1 not in store
+
+def test_flush_writes_changes_and_deletions(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    store = SessionStore(backend=SQLiteBackend(path))
+    store[1] = {'audio_files': ['a.mp3']}
+    store[2] = {'audio_files': []}
+    asyncio.run(store.flush())
+
+    # Sessions are mutated in place after being read
+    store[1]['audio_files'].append('b.mp3')
+    del store[2]
+    asyncio.run(store.flush())
+    store.backend.close()
+
+    restored = SessionStore(backend=SQLiteBackend(path))
+    assert restored.load() == {1: {'audio_files': ['a.mp3', 'b.mp3']}}
+    restored.backend.close()
+
+def test_load_keeps_idle_time(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'sessions.db'))
+    backend.write([(1, '{}', time.time() - 3600), (2, '{}', time.time())], [])
+    store = SessionStore(ttl=600, backend=backend)
+    store.load()
+    assert store.expire() == 1
+    assert list(store) == [2]
+    backend.close()
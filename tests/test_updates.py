@@ -0,0 +1,64 @@
+import asyncio
+
+from telegram import Update
+
+from updates import ChatOrderedUpdateProcessor
+
+def make_update(update_id, chat_id):
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': 'x'
+        }
+    }, None)
+
+def test_updates_of_one_chat_run_in_order():
+    async def main():
+        processor = ChatOrderedUpdateProcessor(max_concurrent=4, max_pending=16)
+        finished = []
+        running = 0
+        most_running = 0
+
+        async def handle(update, delay):
+            nonlocal running, most_running
+            running += 1
+            most_running = max(most_running, running)
+            await asyncio.sleep(delay)
+            running -= 1
+            finished.append((update.effective_chat.id, update.update_id))
+
+        # Earlier updates of a chat take longer than later ones
+        updates = [make_update(update_id, chat_id) for update_id in range(6) for chat_id in (1, 2)]
+        await asyncio.gather(*(
+            processor.process_update(update, handle(update, 0.03 - update.update_id * 0.005))
+            for update in updates
+        ))
+
+        for chat_id in (1, 2):
+            assert [update_id for chat, update_id in finished if chat == chat_id] == list(range(6))
+        # Different chats still ran side by side
+        assert most_running == 2
+        assert processor.active_chats == 0
+    asyncio.run(main())
+
+def test_concurrency_limit_applies_across_chats():
+    async def main():
+        processor = ChatOrderedUpdateProcessor(max_concurrent=2, max_pending=16)
+        running = 0
+        most_running = 0
+
+        async def handle():
+            nonlocal running, most_running
+            running += 1
+            most_running = max(most_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(
+            processor.process_update(make_update(chat_id, chat_id), handle()) for chat_id in range(8)
+        ))
+        assert most_running == 2
+    asyncio.run(main())
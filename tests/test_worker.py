@@ -0,0 +1,93 @@
+import time
+import asyncio
+
+import pytest
+
+import worker
+from worker import RenderQueue, RenderError, Worker
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = RenderQueue(str(tmp_path / 'render.db'))
+    yield queue
+    queue.close()
+
+def test_expired_lease_is_taken_over(queue, monkeypatch):
+    monkeypatch.setattr(worker, 'RENDER_LEASE', 0.05)
+    job_id = queue.enqueue('merge', {'inputs': ['a.mp3']}, chat_id=7, message_id=9)
+    assert queue.claim('first') == (job_id, 'merge', {'inputs': ['a.mp3']}, 7, 9)
+    assert queue.claim('second') is None
+    assert queue.heartbeat(job_id, 'first', 0.5)
+
+    time.sleep(0.1)
+    assert queue.claim('second')[0] == job_id
+    # The first worker finds out it lost the job and its result is ignored
+    assert not queue.heartbeat(job_id, 'first')
+    queue.finish(job_id, 'first', error='late')
+    assert queue.get(job_id)[0] == 'running'
+
+    queue.finish(job_id, 'second', {'output': 'merged.mp3'})
+    assert queue.get(job_id) == ('done', 0, {'output': 'merged.mp3'}, None)
+
+def test_job_fails_after_max_attempts(queue, monkeypatch):
+    monkeypatch.setattr(worker, 'RENDER_LEASE', 0)
+    monkeypatch.setattr(worker, 'RENDER_MAX_ATTEMPTS', 2)
+    job_id = queue.enqueue('video', {})
+    assert queue.claim('first')[0] == job_id
+    assert queue.claim('second')[0] == job_id
+    assert queue.claim('third') is None
+    status, _, _, error = queue.get(job_id)
+    assert status == 'failed'
+    assert 'attempts' in error
+
+def test_worker_renders_queued_jobs(queue, monkeypatch):
+    async def fake_merge(params):
+        await asyncio.sleep(0.05)
+        if not params['inputs']:
+            raise ValueError('nothing to merge')
+        return {'output': '+'.join(params['inputs'])}
+
+    monkeypatch.setitem(worker.RENDERERS, 'merge', fake_merge)
+    monkeypatch.setattr(worker, 'render_queue', queue)
+    monkeypatch.setattr(worker, 'RENDER_POLL_INTERVAL', 0.01)
+
+    async def main():
+        render_worker = Worker(queue, concurrency=2)
+        running = asyncio.create_task(render_worker.run())
+        try:
+            result = await worker.render('merge', {'inputs': ['a', 'b']}, chat_id=1)
+            with pytest.raises(RenderError, match='nothing to merge'):
+                await worker.render('merge', {'inputs': []}, chat_id=2)
+        finally:
+            render_worker.stop()
+            await running
+        return result
+    assert asyncio.run(main()) == {'output': 'a+b'}
+    # Collected jobs are removed from the queue
+    assert queue.purge(age=-1) == 0
+    assert queue.claim('idle') is None
+
+def test_worker_stops_a_job_it_lost(queue, monkeypatch):
+    stopped = []
+
+    async def slow_merge(params):
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            stopped.append(True)
+            raise
+
+    monkeypatch.setitem(worker.RENDERERS, 'merge', slow_merge)
+    monkeypatch.setattr(worker, 'RENDER_HEARTBEAT', 0.02)
+
+    async def main():
+        job_id = queue.enqueue('merge', {'inputs': ['a']})
+        render_worker = Worker(queue)
+        claimed = queue.claim(render_worker.worker_id)
+        processing = asyncio.create_task(render_worker._process(*claimed))
+        await asyncio.sleep(0.05)
+        # The bot gave up on the job, e.g. the user cancelled it
+        queue.delete(job_id)
+        await asyncio.wait_for(processing, 1)
+    asyncio.run(main())
+    assert stopped == [True]
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from workspace import WorkspaceManager, QuotaExceededError
+
+def write(path, nbytes):
+    with open(path, 'wb') as file:
+        file.write(b'x' * nbytes)
+
+def test_workspaces_are_private_and_removed(tmp_path):
+    manager = WorkspaceManager(root=str(tmp_path))
+    with manager.create(7) as workspace:
+        assert os.path.basename(workspace.directory).startswith('7-')
+        # Names from uploads cannot escape the workspace
+        assert workspace.path('../../etc/passwd') == os.path.join(workspace.directory, 'passwd')
+        write(workspace.path('a.mp3'), 100)
+        assert workspace.usage() == 100
+        assert manager.open(workspace.directory).user_id == 7
+    assert not os.path.exists(workspace.directory)
+
+def test_quotas_per_user_and_global(tmp_path):
+    manager = WorkspaceManager(root=str(tmp_path), user_quota=1000, global_quota=1500)
+    first = manager.create(1)
+    second = manager.create(2)
+    write(first.path('a.mp3'), 900)
+
+    first.reserve(100)
+    with pytest.raises(QuotaExceededError) as error:
+        first.reserve(101)
+    assert error.value.scope == 'user'
+
+    second.reserve(600)
+    with pytest.raises(QuotaExceededError) as error:
+        second.reserve(601)
+    assert error.value.scope == 'global'
+
+def test_sweep_keeps_live_workspaces(tmp_path):
+    manager = WorkspaceManager(root=str(tmp_path))
+    live = manager.create(1)
+    orphan = manager.create(2)
+    write(os.path.join(manager.root, 'stray.mp4'), 10)
+
+    assert manager.sweep(keep=[live.directory, None]) == 2
+    assert os.path.isdir(live.directory)
+    assert not os.path.exists(orphan.directory)
+
+def test_held_downloads_count_until_written(tmp_path):
+    manager = WorkspaceManager(root=str(tmp_path), user_quota=1000, global_quota=10000)
+    workspace = manager.create(1)
+    path = workspace.path('a.mp3')
+    manager.hold(1, path, 600)
+    with pytest.raises(QuotaExceededError):
+        workspace.reserve(500)
+
+    # Bytes already written (under the .part name) are not counted twice
+    write(f"{path}.part", 400)
+    assert manager.held(1) == 200
+    assert manager.held(2) == 0
+    workspace.reserve(400)
+
+    manager.release(path)
+    assert manager.held() == 0
@@ -0,0 +1,63 @@
+import os
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates handled at the same time across all chats
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 32))
+
+# Updates taken off the queue at once, including those waiting for an
+# earlier update of the same chat to finish
+MAX_PENDING_UPDATES = int(os.getenv('MAX_PENDING_UPDATES', 1024))
+
+# Processes updates of different chats concurrently but the updates of one
+# chat strictly one after another, in arrival order, so per-user session
+# state (file lists, indexes derived from their length) never races.
+# The global limit is taken only once the chat's turn has come, so one
+# chat flooding updates cannot occupy every slot while it waits.
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent=UPDATE_CONCURRENCY, max_pending=MAX_PENDING_UPDATES):
+        super().__init__(max(max_concurrent, max_pending))
+        self.max_running = max_concurrent
+        self._running = asyncio.BoundedSemaphore(max_concurrent)
+        # chat_id -> [lock, number of updates holding or waiting for it]
+        self._chats = {}
+
+    @staticmethod
+    def _chat_id(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = self._chat_id(update)
+        if chat_id is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._chats.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat_id]
+
+    # Chats with an update running or waiting
+    @property
+    def active_chats(self):
+        return len(self._chats)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,297 @@
+import os
+import re
+import json
+import time
+import uuid
+import signal
+import asyncio
+import logging
+import sqlite3
+import shutil
+import socket
+import tempfile
+import threading
+
+from jobs import media_executor, progress_dir
+from media import concat_audios, append_audios, render_still_video
+from metrics import current_job, stage_timer
+
+logger = logging.getLogger(__name__)
+
+# SQLite database holding the render queue. When set, the bot hands merge,
+# add-more and video renders to worker processes (`python server.py
+# --role worker`) instead of running ffmpeg itself. The database and
+# SCRATCH_DIR must be on storage shared by the bot and all workers; the
+# bot's MAX_ACTIVE_JOBS then bounds jobs in flight across all workers.
+RENDER_QUEUE = os.getenv('RENDER_QUEUE')
+
+# How often the bot checks a queued job and an idle worker looks for work (seconds)
+RENDER_POLL_INTERVAL = float(os.getenv('RENDER_POLL_INTERVAL', 0.5))
+
+# A running job whose worker has not reported for RENDER_LEASE seconds is
+# handed to another worker, at most RENDER_MAX_ATTEMPTS times in total
+RENDER_LEASE = float(os.getenv('RENDER_LEASE', 60))
+RENDER_MAX_ATTEMPTS = int(os.getenv('RENDER_MAX_ATTEMPTS', 3))
+
+# How often a worker renews its lease; a job the bot has given up on (e.g.
+# cancelled) is stopped within this many seconds
+RENDER_HEARTBEAT = float(os.getenv('RENDER_HEARTBEAT', 5))
+
+# Jobs one worker process renders at once
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', 0)) or media_executor.slots
+
+# Finished jobs nobody collected (e.g. the bot restarted) are deleted after this many seconds
+RENDER_RETENTION = int(os.getenv('RENDER_RETENTION', 24 * 3600))
+
+# Raised on the bot side when a worker reports a failed render
+class RenderError(Exception):
+    pass
+
+# Durable job queue in a SQLite database. Rows go queued -> running ->
+# done/failed; a running row's `updated` is its worker's heartbeat and
+# `progress` the share of the job's media rendered so far (0 to 1).
+class RenderQueue:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        # No WAL: it needs shared memory, which network filesystems lack
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS render_jobs ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, params TEXT NOT NULL, '
+            'chat_id INTEGER, message_id INTEGER, status TEXT NOT NULL, worker TEXT, '
+            'attempts INTEGER NOT NULL DEFAULT 0, progress REAL, result TEXT, error TEXT, '
+            'created REAL NOT NULL, updated REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS render_jobs_status ON render_jobs (status, id)')
+
+    # Run `func(conn)` in one write transaction
+    def _write(self, func):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(self._conn)
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            return result
+
+    def enqueue(self, kind, params, chat_id=None, message_id=None):
+        now = time.time()
+        return self._write(lambda conn: conn.execute(
+            'INSERT INTO render_jobs (kind, params, chat_id, message_id, status, created, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (kind, json.dumps(params), chat_id, message_id, 'queued', now, now)
+        ).lastrowid)
+
+    # Take the oldest queued job, or one whose worker stopped reporting;
+    # returns (id, kind, params, chat_id, message_id) or None
+    def claim(self, worker_id):
+        def claim(conn):
+            now = time.time()
+            while True:
+                row = conn.execute(
+                    "SELECT id, kind, params, chat_id, message_id, attempts FROM render_jobs "
+                    "WHERE status = 'queued' OR (status = 'running' AND updated < ?) ORDER BY id LIMIT 1",
+                    (now - RENDER_LEASE,)
+                ).fetchone()
+                if row is None:
+                    return None
+                job_id, kind, params, chat_id, message_id, attempts = row
+                if attempts >= RENDER_MAX_ATTEMPTS:
+                    conn.execute(
+                        "UPDATE render_jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                        (f"Gave up after {attempts} attempts", now, job_id)
+                    )
+                    continue
+                conn.execute(
+                    "UPDATE render_jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                    "progress = 0, updated = ? WHERE id = ?",
+                    (worker_id, now, job_id)
+                )
+                return job_id, kind, json.loads(params), chat_id, message_id
+        return self._write(claim)
+
+    # Renew a worker's lease and record its progress; False when the job is
+    # no longer its own
+    def heartbeat(self, job_id, worker_id, progress=None):
+        return self._write(lambda conn: conn.execute(
+            "UPDATE render_jobs SET updated = ?, progress = COALESCE(?, progress) "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time(), progress, job_id, worker_id)
+        ).rowcount == 1)
+
+    def finish(self, job_id, worker_id, result=None, error=None):
+        self._write(lambda conn: conn.execute(
+            "UPDATE render_jobs SET status = ?, result = ?, error = ?, updated = ? "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            ('failed' if error else 'done', json.dumps(result), error, time.time(), job_id, worker_id)
+        ))
+
+    # (status, progress, result, error) of a job, or None when it is gone
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT status, progress, result, error FROM render_jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        status, progress, result, error = row
+        return status, progress, json.loads(result) if result else None, error
+
+    def delete(self, job_id):
+        self._write(lambda conn: conn.execute('DELETE FROM render_jobs WHERE id = ?', (job_id,)))
+
+    # Delete finished jobs older than `age` seconds
+    def purge(self, age=RENDER_RETENTION):
+        return self._write(lambda conn: conn.execute(
+            "DELETE FROM render_jobs WHERE status IN ('done', 'failed') AND updated < ?",
+            (time.time() - age,)
+        ).rowcount)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+render_queue = RenderQueue(RENDER_QUEUE) if RENDER_QUEUE else None
+
+# Media seconds the furthest ffmpeg process has written, from the
+# `-progress` reports in `directory`
+def read_progress(directory):
+    furthest = 0
+    for entry in os.scandir(directory):
+        with open(entry.path) as report:
+            times = re.findall(r'^out_time_us=(\d+)$', report.read(), re.MULTILINE)
+        if times:
+            furthest = max(furthest, int(times[-1]) / 1e6)
+    return furthest
+
+# Renders by job kind; params hold workspace paths, cache keys and the
+# `duration` of media to render, which progress is measured against
+async def _render_merge(params):
+    return {'output': await concat_audios(params['inputs'], params['output'], cache_keys=params.get('cache_keys'))}
+
+async def _render_add_more(params):
+    # A retried job starts again from the base as it was enqueued
+    if os.path.getsize(params['base']) > params['base_size']:
+        os.truncate(params['base'], params['base_size'])
+    return {'output': await append_audios(params['base'], params['inputs'], params.get('cache_keys'))}
+
+async def _render_video(params):
+    return {'output': await render_still_video(params['image'], params['audio'], params['output'])}
+
+RENDERERS = {
+    'merge': _render_merge,
+    'add_more': _render_add_more,
+    'video': _render_video
+}
+
+# Run a render here, or through the render queue when one is configured.
+# chat_id/message_id identify the job's chat and status message; a queued
+# job calls `on_progress(share)` whenever its worker reports progress.
+async def render(kind, params, chat_id=None, message_id=None, on_progress=None):
+    if render_queue is None:
+        return await RENDERERS[kind](params)
+
+    job_id = await asyncio.to_thread(render_queue.enqueue, kind, params, chat_id, message_id)
+    logger.info(f"Queued {kind} render {job_id} for chat {chat_id}")
+    try:
+        with stage_timer('encode'):
+            shown = None
+            while True:
+                await asyncio.sleep(RENDER_POLL_INTERVAL)
+                row = await asyncio.to_thread(render_queue.get, job_id)
+                if row is None:
+                    raise RenderError(f"Render {job_id} disappeared from the queue")
+                status, progress, result, error = row
+                if on_progress is not None and progress is not None and progress != shown:
+                    on_progress(progress)
+                    shown = progress
+                if status == 'done':
+                    return result
+                if status == 'failed':
+                    raise RenderError(error)
+    finally:
+        await asyncio.to_thread(render_queue.delete, job_id)
+
+# Consumes the render queue with up to WORKER_CONCURRENCY jobs at a time,
+# renewing each job's lease while it runs
+class Worker:
+    def __init__(self, queue, concurrency=WORKER_CONCURRENCY):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._stopping = asyncio.Event()
+        self._tasks = set()
+
+    def stop(self):
+        self._stopping.set()
+
+    async def run(self):
+        logger.info(f"Worker {self.worker_id} running {self.concurrency} jobs at a time")
+        last_purge = 0
+        while not self._stopping.is_set():
+            if time.monotonic() - last_purge > 3600:
+                await asyncio.to_thread(self.queue.purge)
+                last_purge = time.monotonic()
+            claimed = None
+            if len(self._tasks) < self.concurrency:
+                claimed = await asyncio.to_thread(self.queue.claim, self.worker_id)
+            if claimed is None:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), RENDER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self._process(*claimed))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        # Running jobs are finished; queued ones stay for other workers
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _process(self, job_id, kind, params, chat_id, message_id):
+        logger.info(f"Rendering {kind} job {job_id} (chat {chat_id}, message {message_id})")
+        current_job.set(kind)
+        reports = tempfile.mkdtemp(prefix='avbot-progress-')
+        progress_dir.set(reports)
+        render_task = asyncio.create_task(RENDERERS[kind](params))
+        try:
+            while True:
+                done, _ = await asyncio.wait({render_task}, timeout=min(RENDER_HEARTBEAT, RENDER_LEASE / 3))
+                if done:
+                    break
+                progress = None
+                if params.get('duration'):
+                    progress = min(1.0, await asyncio.to_thread(read_progress, reports) / params['duration'])
+                # Gone when the bot stopped waiting for it or another worker took it over
+                if not await asyncio.to_thread(self.queue.heartbeat, job_id, self.worker_id, progress):
+                    logger.warning(f"Lost render job {job_id}, stopping it")
+                    return
+            result = render_task.result()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error rendering {kind} job {job_id}: {e}")
+            await asyncio.to_thread(self.queue.finish, job_id, self.worker_id, error=str(e) or type(e).__name__)
+            return
+        finally:
+            if not render_task.done():
+                render_task.cancel()
+                await asyncio.gather(render_task, return_exceptions=True)
+            shutil.rmtree(reports, ignore_errors=True)
+        await asyncio.to_thread(self.queue.finish, job_id, self.worker_id, result)
+        logger.info(f"Finished {kind} job {job_id}")
+
+# Entry point of `python server.py --role worker`: render until SIGINT/SIGTERM
+async def run_worker():
+    if render_queue is None:
+        raise RuntimeError("RENDER_QUEUE is not set")
+    worker = Worker(render_queue)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    try:
+        await worker.run()
+    finally:
+        render_queue.close()
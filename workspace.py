@@ -0,0 +1,150 @@
+import os
+import uuid
+import shutil
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Per-user and global limits on scratch disk usage
+USER_QUOTA = int(os.getenv('USER_QUOTA_MB', 1024)) * MB
+GLOBAL_QUOTA = int(os.getenv('SCRATCH_QUOTA_MB', 8192)) * MB
+
+# Raised when storing more bytes would exceed a scratch quota;
+# `scope` is 'user' or 'global'
+class QuotaExceededError(Exception):
+    def __init__(self, scope, needed):
+        super().__init__(f"{scope} scratch quota exceeded ({needed} bytes needed)")
+        self.scope = scope
+        self.needed = needed
+
+# Scratch root: SCRATCH_DIR if set, tmpfs when it is large enough for the
+# global quota, otherwise the system temp dir
+def _default_root():
+    if os.getenv('SCRATCH_DIR'):
+        return os.getenv('SCRATCH_DIR')
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK) and shutil.disk_usage(shm).free >= GLOBAL_QUOTA:
+        return os.path.join(shm, 'avbot')
+    return os.path.join(tempfile.gettempdir(), 'avbot')
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+# A private scratch directory for one user's session; deleted on cleanup()
+# or when used as a context manager
+class Workspace:
+    def __init__(self, manager, user_id, directory):
+        self.manager = manager
+        self.user_id = user_id
+        self.directory = directory
+
+    # Path for a file inside the workspace (any directory part is dropped)
+    def path(self, name):
+        return os.path.join(self.directory, os.path.basename(name))
+
+    def usage(self):
+        return _dir_size(self.directory)
+
+    # Raise QuotaExceededError if nbytes more would not fit
+    def reserve(self, nbytes):
+        self.manager.check_quota(self.user_id, nbytes)
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+# Creates workspaces under one root and enforces the byte quotas
+class WorkspaceManager:
+    def __init__(self, root=None, user_quota=USER_QUOTA, global_quota=GLOBAL_QUOTA):
+        self.root = root or _default_root()
+        self.user_quota = user_quota
+        self.global_quota = global_quota
+        # path -> (user_id, bytes) of downloads started but not finished
+        self._holds = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def create(self, user_id):
+        directory = os.path.join(self.root, f"{user_id}-{uuid.uuid4().hex[:12]}")
+        os.makedirs(directory)
+        return Workspace(self, user_id, directory)
+
+    # Reopen a workspace from its stored path (recreated if it vanished)
+    def open(self, directory):
+        user_id = int(os.path.basename(directory).split('-')[0])
+        os.makedirs(directory, exist_ok=True)
+        return Workspace(self, user_id, directory)
+
+    def remove(self, directory):
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # Bytes used by one user's workspaces, or by all of them
+    def usage(self, user_id=None):
+        total = 0
+        for entry in os.scandir(self.root):
+            if user_id is None or entry.name.startswith(f"{user_id}-"):
+                total += _dir_size(entry.path)
+        return total
+
+    # Count `nbytes` about to be written at `path` against the quotas until
+    # release(path), so concurrent downloads cannot all pass check_quota
+    # before any byte has landed
+    def hold(self, user_id, path, nbytes):
+        if nbytes:
+            self._holds[path] = (user_id, nbytes)
+
+    def release(self, path):
+        self._holds.pop(path, None)
+
+    # Held bytes not on disk yet, of one user or of everyone
+    def held(self, user_id=None):
+        total = 0
+        for path, (owner, nbytes) in self._holds.items():
+            if user_id is not None and owner != user_id:
+                continue
+            written = 0
+            for name in (path, f"{path}.part"):
+                try:
+                    written = max(written, os.path.getsize(name))
+                except OSError:
+                    pass
+            total += max(0, nbytes - written)
+        return total
+
+    def check_quota(self, user_id, nbytes):
+        if self.usage(user_id) + self.held(user_id) + nbytes > self.user_quota:
+            raise QuotaExceededError('user', nbytes)
+        if self.usage() + self.held() + nbytes > self.global_quota:
+            raise QuotaExceededError('global', nbytes)
+
+    # Delete every workspace not listed in `keep` (orphans of a previous run)
+    def sweep(self, keep=()):
+        keep = {os.path.abspath(path) for path in keep if path}
+        removed = 0
+        for entry in os.scandir(self.root):
+            if os.path.abspath(entry.path) in keep:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+            removed += 1
+        if removed:
+            logger.info(f"Removed {removed} orphaned scratch entries from {self.root}")
+        return removed
+
+workspaces = WorkspaceManager()